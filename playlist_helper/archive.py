@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+"""Compressed dump storage: every track record once, and playlists as lists of track ids.
+
+`dump.py --archive` writes, per user:
+
+    dumps/<username>/archive/manifest.json    : the username, where the track table is and
+                                                hashes per playlist, for dumpdiff.py
+    dumps/<username>/archive/playlists.json.gz: one json line per playlist, its fields and track ids
+    dumps/<username>/archive/tracks.json.gz   : one json line per distinct track record
+
+With `--shared-tracks` every user's playlists point into one table,
+dumps/tracks.json.gz, which later runs append to. A track id is its key; a
+record that differs from the one already stored under its key (say, with
+extra fields) gets the key plus a hash of its content. Records and playlist
+fields are stored as [name, value] pairs, so exported files list them in the
+same order a live dump did.
+
+The classic per-playlist files can be regenerated from an archive at any time:
+
+    python playlist_helper/archive.py dumps/jmullan/archive
+"""
+import gzip
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from optparse import OptionParser
+
+from tracks import compact_tracks
+
+MANIFEST = 'manifest.json'
+PLAYLISTS = 'playlists.json.gz'
+TRACKS = 'tracks.json.gz'
+SHARED_TRACKS = 'dumps/%s' % TRACKS
+COMPRESS_LEVEL = 6
+
+
+def _digest(record):
+    return hashlib.sha1(json.dumps(record, sort_keys=True)).digest()
+
+
+def playlist_digests(fields, track_keys):
+    """Hash a playlist's tracks, in order, apart from its other fields, so a diff can tell which changed.
+
+    `fields` are (name, value) pairs; they are hashed in name order and as
+    text, the way the jspf files hold them.
+    """
+    tracks = hashlib.sha1(u'\n'.join(track_keys).encode('utf-8')).hexdigest()
+    meta = hashlib.sha1(json.dumps(sorted((name, unicode(value)) for name, value in fields))).hexdigest()
+    return tracks, meta
+
+
+def index_name(fields):
+    """How an archive's index names a playlist: "<playlist_type>/<key or name>"."""
+    # the favorites and downloaded playlists have no key
+    return '%s/%s' % (fields['playlist_type'], fields.get('key') or fields['name'])
+
+
+def track_identity(track_id):
+    """The track key in an archive track id, or the whole id for a track without a key."""
+    return track_id.split('#')[0] or track_id
+
+
+def read_lines(filename):
+    """Yield the json value on each line of a gzip file."""
+    with gzip.open(filename, 'rb') as infile:
+        for line in infile:
+            yield json.loads(line)
+
+
+class TrackTable(object):
+    """A gzip json-lines file holding each distinct track record once, safe to share between threads.
+
+    With `append`, the records already in the file are kept and not written again.
+    """
+
+    def __init__(self, filename, append=False):
+        self.filename = filename
+        self.written = 0
+        self.references = 0
+        self._lock = threading.Lock()
+        # track key -> {content digest: id}
+        self._ids = {}
+        if append and os.path.exists(filename):
+            for line in read_lines(filename):
+                record = dict(line['track'])
+                self._ids.setdefault(record.get('key'), {})[_digest(record)] = line['id']
+        self._outfile = gzip.open(filename, 'ab' if append else 'wb', COMPRESS_LEVEL)
+
+    def track_id(self, track):
+        """The id of a track record, writing the record out the first time its content is seen."""
+        items = track.items()
+        record = dict(items)
+        key = record.get('key')
+        digest = _digest(record)
+        with self._lock:
+            self.references += 1
+            ids = self._ids.setdefault(key, {})
+            track_id = ids.get(digest)
+            if track_id is None:
+                track_id = key if key and not ids else '%s#%s' % (key or '', digest.encode('hex')[:12])
+                ids[digest] = track_id
+                self._outfile.write(json.dumps({'id': track_id, 'track': items}) + '\n')
+                self.written += 1
+            return track_id
+
+    def close(self):
+        with self._lock:
+            if self._outfile is not None:
+                self._outfile.close()
+                self._outfile = None
+
+
+class ArchiveWriter(object):
+    """Write one user's playlists into an archive folder, with their tracks in `tracks`."""
+
+    def __init__(self, folder, username, tracks):
+        self.folder = folder
+        self.username = username
+        self.tracks = tracks
+        self.playlists = 0
+        # index_name -> [line number, tracks digest, fields digest]
+        self.index = {}
+        self._outfile = gzip.open(os.path.join(folder, PLAYLISTS), 'wb', COMPRESS_LEVEL)
+
+    def write_playlist(self, playlist):
+        fields = [(key, value) for key, value in playlist.items() if key != 'tracks']
+        track_ids = [self.tracks.track_id(track) for track in playlist['tracks']]
+        tracks_digest, meta_digest = playlist_digests(fields, [track_identity(track_id) for track_id in track_ids])
+        self.index[index_name(playlist)] = [self.playlists, tracks_digest, meta_digest]
+        self._outfile.write(json.dumps({'playlist': fields, 'tracks': track_ids}) + '\n')
+        self.playlists += 1
+
+    def close(self):
+        if self._outfile is None:
+            return
+        self._outfile.close()
+        self._outfile = None
+        manifest = {
+          'username': self.username,
+          'playlists': PLAYLISTS,
+          'tracks': os.path.relpath(self.tracks.filename, self.folder),
+          'codec': 'gzip',
+          'index': self.index,
+        }
+        with open(os.path.join(self.folder, MANIFEST), 'w') as outfile:
+            json.dump(manifest, outfile, indent=2)
+
+
+def read_archive(folder):
+    """Yield the playlists of an archive folder as dump.py had them, tracks and all."""
+    with open(os.path.join(folder, MANIFEST)) as infile:
+        manifest = json.load(infile)
+    playlists_filename = os.path.join(folder, manifest['playlists'])
+    wanted = set()
+    for line in read_lines(playlists_filename):
+        wanted.update(line['tracks'])
+    # a shared table can hold far more tracks than this user needs
+    tracks = {}
+    strings = {}
+    for line in read_lines(os.path.join(folder, manifest['tracks'])):
+        if line['id'] in wanted:
+            tracks[line['id']] = compact_tracks([OrderedDict(line['track'])], strings)[0]
+    for line in read_lines(playlists_filename):
+        playlist = OrderedDict(line['playlist'])
+        playlist['tracks'] = [tracks[track_id] for track_id in line['tracks']]
+        yield playlist
+
+
+def export(folder):
+    """Write the classic per-playlist files for an archive, under dumps/<username>/playlists."""
+    from dump import dump_playlist
+    with open(os.path.join(folder, MANIFEST)) as infile:
+        user = {'username': json.load(infile)['username'], '_playlists': set()}
+    exported = 0
+    for playlist in read_archive(folder):
+        dump_playlist(user, playlist)
+        exported += 1
+    return exported
+
+
+def main(options, args):
+    for folder in args:
+        print '%s: exported %d playlists' % (folder, export(folder))
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage='%prog ARCHIVE_FOLDER...')
+    (options, args) = parser.parse_args()
+    options = options.__dict__
+    main(options, args)
@@ -0,0 +1,276 @@
+"""A non-blocking front for PlaylistCreator, for services that can't wait on the API.
+
+Calls return at once. Single results come back as a Job, paged listings as a
+Stream that yields items as background threads fetch them. Both can be
+cancelled. At most `limit` calls use the API at a time. The matching and the
+caches are the wrapped PlaylistCreator's own.
+
+    apc = AsyncPlaylistCreator()
+    job = apc.make_playlist('Road trip', 'Songs for the car', rows)
+    job.add_done_callback(lambda job: LOGGER.info('done: %s', job.exception()))
+    for playlist in apc.list_playlists():
+        ...
+"""
+import logging
+import Queue
+import sys
+import threading
+
+from playlistcreator import PlaylistCreator
+
+LOGGER = logging.getLogger(__name__)
+
+_END = object()
+
+
+class Cancelled(Exception):
+    """The Job or Stream was cancelled before it finished."""
+
+
+class Job(object):
+    """The result of one call, filled in by a background thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+        self._started = False
+        self._cancelled = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def cancel(self):
+        """Stop the call if it has not started yet; returns whether it was stopped."""
+        with self._lock:
+            if self._started or self._finished.is_set():
+                return False
+            self._cancelled = True
+        self._finish(None, (Cancelled, Cancelled(), None))
+        return True
+
+    def cancelled(self):
+        return self._cancelled
+
+    def done(self):
+        return self._finished.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the call and return its value, raising whatever it raised."""
+        if not self._finished.wait(timeout):
+            raise RuntimeError('Job still running after %s seconds' % timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        try:
+            self.result(timeout)
+        except Exception as ex:
+            return ex
+        return None
+
+    def add_done_callback(self, callback):
+        """Call callback(job) once the job is done, from the thread that finished it."""
+        with self._lock:
+            if not self._finished.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _start(self):
+        with self._lock:
+            if self._cancelled:
+                return False
+            self._started = True
+            return True
+
+    def _finish(self, result, exc_info):
+        with self._lock:
+            self._result = result
+            self._exc_info = exc_info
+            self._finished.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                LOGGER.exception('Job callback failed')
+
+
+class Stream(object):
+    """Items from one of PlaylistCreator's paging generators, fetched ahead on a background thread.
+
+    Up to `buffer_size` items are fetched before the reader takes them.
+    Cancelling stops the fetching after the page in flight, and iteration
+    then raises Cancelled.
+    """
+
+    def __init__(self, slots, generator, buffer_size, on_done=None):
+        self._slots = slots
+        self._generator = generator
+        self._items = Queue.Queue(buffer_size)
+        self._cancelled = threading.Event()
+        self._exhausted = False
+        self._on_done = on_done
+        self._thread = threading.Thread(target=self._produce)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def join(self, timeout=None):
+        """Wait for the background thread to stop fetching."""
+        self._thread.join(timeout)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._exhausted:
+            raise StopIteration
+        while True:
+            if self._cancelled.is_set():
+                self._exhausted = True
+                raise Cancelled()
+            try:
+                kind, value = self._items.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            if kind is _END:
+                self._exhausted = True
+                if value is not None:
+                    raise value[0], value[1], value[2]
+                raise StopIteration
+            return value
+
+    def _put(self, kind, value):
+        while not self._cancelled.is_set():
+            try:
+                self._items.put((kind, value), timeout=0.1)
+                return True
+            except Queue.Full:
+                continue
+        return False
+
+    def _produce(self):
+        exc_info = None
+        try:
+            while not self._cancelled.is_set():
+                # hold a slot only while fetching, so a slow reader doesn't keep others waiting
+                with self._slots:
+                    try:
+                        item = self._generator.next()
+                    except StopIteration:
+                        break
+                if not self._put(None, item):
+                    break
+        except Exception:
+            exc_info = sys.exc_info()
+        finally:
+            self._generator.close()
+        self._put(_END, exc_info)
+        if self._on_done is not None:
+            self._on_done(self)
+
+
+class AsyncPlaylistCreator(object):
+    """Run PlaylistCreator calls on background threads, at most `limit` at a time.
+
+    `pc` is the PlaylistCreator to share, or one is made from `kwargs`;
+    `limit` defaults to its concurrency setting.
+    """
+
+    def __init__(self, pc=None, limit=None, buffer_size=100, **kwargs):
+        self._owns_pc = pc is None
+        self.pc = PlaylistCreator(**kwargs) if pc is None else pc
+        self.limit = limit or self.pc.concurrency
+        self.buffer_size = buffer_size
+        self._slots = threading.BoundedSemaphore(self.limit)
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._streams = set()
+
+    def submit(self, function, *args, **kwargs):
+        """Call function(*args, **kwargs) in the background; returns its Job."""
+        job = Job()
+        with self._lock:
+            self._pending.add(job)
+        job.add_done_callback(self._forget)
+        thread = threading.Thread(target=self._run, args=(job, function, args, kwargs))
+        thread.daemon = True
+        thread.start()
+        return job
+
+    def _forget(self, job):
+        with self._lock:
+            self._pending.discard(job)
+
+    def _run(self, job, function, args, kwargs):
+        with self._slots:
+            if not job._start():
+                return
+            try:
+                result = function(*args, **kwargs)
+            except Exception:
+                job._finish(None, sys.exc_info())
+            else:
+                job._finish(result, None)
+
+    def stream(self, generator_function, *args, **kwargs):
+        """Iterate generator_function(*args, **kwargs) in the background; returns its Stream."""
+        # held until the stream is added, so a stream that ends at once can't be forgotten first
+        with self._lock:
+            stream = Stream(self._slots, generator_function(*args, **kwargs), self.buffer_size, self._forget_stream)
+            self._streams.add(stream)
+        return stream
+
+    def _forget_stream(self, stream):
+        with self._lock:
+            self._streams.discard(stream)
+
+    def make_playlist(self, name, desc, tracks):
+        return self.submit(self.pc.make_playlist, name, desc, tracks)
+
+    def make_playlist_from_keys(self, name, desc, track_keys):
+        return self.submit(self.pc.make_playlist_from_keys, name, desc, track_keys)
+
+    def list_comments(self, current_user=None):
+        return self.submit(self.pc.list_comments, current_user)
+
+    def get_favorites_playlist(self, current_user=None):
+        return self.submit(self.pc.get_favorites_playlist, current_user)
+
+    def get_offline_tracks(self, current_user=None):
+        return self.submit(self.pc.get_offline_tracks, current_user)
+
+    def list_playlists(self, current_user=None):
+        return self.stream(self.pc.list_playlists, current_user)
+
+    def get_favorite_artists(self, current_user=None):
+        return self.stream(self.pc.get_favorite_artists, current_user)
+
+    def get_favorite_labels(self, current_user=None):
+        return self.stream(self.pc.get_favorite_labels, current_user)
+
+    def get_favorite_stations(self, current_user=None):
+        return self.stream(self.pc.get_favorite_stations, current_user)
+
+    def close(self):
+        """Cancel what has not started, wait for what has, then close the PlaylistCreator if it was made here."""
+        with self._lock:
+            pending = list(self._pending)
+            streams = list(self._streams)
+        for stream in streams:
+            stream.cancel()
+        for job in pending:
+            if not job.cancel():
+                job._finished.wait()
+        # a cancelled stream stops after the page in flight
+        for stream in streams:
+            stream.join()
+        if self._owns_pc:
+            self.pc.close()
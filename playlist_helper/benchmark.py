@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""Time PlaylistCreator end to end against an in-process fake Rdio API."""
+import codecs
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+import dump
+from fakerdio import FakeRdio
+from playlistcreator import PlaylistCreator
+
+logging.basicConfig()
+
+DUMP_OPTIONS = {'username': None, 'email': None, 'uid_key': None, 'users_file': None}
+
+
+def run_scenario(name, size, client, function):
+    """Run function once, returning its wall time and the API calls it made."""
+    before = dict(client.calls)
+    stdout = sys.stdout
+    started = time.time()
+    # the paging loops print progress, including unicode playlist names; keep it out of the results
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = codecs.getwriter('utf-8')(devnull)
+        try:
+            function()
+        finally:
+            sys.stdout = stdout
+    elapsed = time.time() - started
+    calls = dict(
+      (method, count - before.get(method, 0))
+      for method, count in client.calls.items() if count != before.get(method, 0)
+    )
+    return {
+      'scenario': name,
+      'size': size,
+      'seconds': elapsed,
+      'calls': calls,
+      'total_calls': sum(calls.values()),
+    }
+
+
+def benchmark_size(size, options):
+    """Run every scenario against a fresh catalog of `size` tracks in a scratch directory."""
+    client = FakeRdio(
+      tracks=size,
+      playlists=max(4, size // 500),
+      favorites=max(20, size // 10),
+      comments=max(5, size // 200),
+      latency=options['latency'],
+      page_limit=options['page_limit'],
+    )
+    rows = client.sample_input(options['rows'])
+    settings = {'rate_limit': 1e9, 'rate_burst': 1e9, 'concurrency': options['concurrency']}
+
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='playlist_helper_benchmark')
+    os.chdir(workdir)
+    try:
+        pc = PlaylistCreator(client=client, settings=settings)
+        user = pc.get_user()
+        results = [
+          run_scenario('make_playlist', size, client, lambda: pc.make_playlist('Benchmark', 'Benchmark', rows)),
+          run_scenario('make_playlist cached', size, client, lambda: pc.make_playlist('Benchmark', 'Benchmark', rows)),
+          run_scenario('list_playlists', size, client, lambda: list(pc.list_playlists(user))),
+          run_scenario('list_comments', size, client, lambda: pc.list_comments(user)),
+          run_scenario('dump.main', size, client, lambda: dump.main(DUMP_OPTIONS, [], pc=pc)),
+        ]
+        pc.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+    return results
+
+
+def format_results(results):
+    lines = ['%-22s %8s %9s %7s  %s' % ('scenario', 'tracks', 'seconds', 'calls', 'calls by method')]
+    for result in results:
+        lines.append('%-22s %8d %9.3f %7d  %s' % (
+          result['scenario'], result['size'], result['seconds'], result['total_calls'],
+          ', '.join('%s=%d' % item for item in sorted(result['calls'].items()))))
+    return '\n'.join(lines)
+
+
+def main(options, args):
+    if not options['verbose']:
+        logging.getLogger().setLevel(logging.ERROR)
+    results = []
+    for size in [int(size) for size in options['sizes'].split(',')]:
+        results += benchmark_size(size, options)
+    print format_results(results)
+    if options['json']:
+        with open(options['json'], 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option(
+      "-s", "--sizes", dest="sizes", default="1000,10000",
+      help="comma separated catalog sizes, in tracks", metavar="SIZES"
+    )
+    parser.add_option(
+      "-r", "--rows", dest="rows", type="int", default=100,
+      help="input rows for make_playlist", metavar="ROWS"
+    )
+    parser.add_option(
+      "-l", "--latency", dest="latency", type="float", default=0.0,
+      help="seconds the fake API sleeps per call", metavar="SECONDS"
+    )
+    parser.add_option(
+      "--page-limit", dest="page_limit", type="int", default=None,
+      help="most items the fake API returns per page", metavar="COUNT"
+    )
+    parser.add_option(
+      "-c", "--concurrency", dest="concurrency", type="int", default=1,
+      help="PlaylistCreator concurrency setting", metavar="THREADS"
+    )
+    parser.add_option(
+      "--json", dest="json", default=None,
+      help="also write the results to FILE as json", metavar="FILE"
+    )
+    parser.add_option("-v", "--verbose", dest="verbose", action="store_true", default=False)
+    (options, args) = parser.parse_args()
+    options = options.__dict__
+    main(options, args)
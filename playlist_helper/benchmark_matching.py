@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Micro-benchmarks for the fuzzy matching code: Term.forms, Term.__eq__, fuzz and levenshtein_distance."""
+import gc
+import imp
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+import types
+from optparse import OptionParser
+
+_PATH = os.path.dirname(os.path.realpath(__file__))
+
+ARTISTS = [
+  u'The Beatles', u'Beatles, The', u'Simon & Garfunkel', u'Simon and Garfunkel', u'Jay-Z feat. Alicia Keys',
+  u'Jay-Z', u'Björk', u'Bjork', u'Sigur Rós', u'Motörhead', u'Beyoncé', u'Beyonce featuring Jay-Z',
+  u'AC/DC', u"Guns N' Roses", u'!!!', u'The The', u'Godley & Creme', u'Kool Keith', u'Dr. Octagon',
+  u'Jennifer Lopez feat. Iggy Azalea', u'Infectious Grooves', u'Florence + the Machine', u'The Rolling Stones',
+  u'Rolling Stones, The', u'Édith Piaf', u'Mötley Crüe', u'Queen', u'Daft Punk', u'Prince & The Revolution',
+]
+
+TITLES = [
+  u'Something', u'Something (Remastered 2009)', u'Empire State of Mind', u'Empire State of Mind (Part II) Broken Down',
+  u'Hey Jude', u'Hey Jude (Live)', u'Jóga', u'Hoppípolla', u'Ace of Spades', u'Crazy in Love', u'Booty',
+  u'Booty Clap (Mr. Sche remix)', u'Snack Attack', u'Can I Touch Ya Butt Girl?', u'Big Big Butt, by Infectiphibian',
+  u"Sweet Child O' Mine", u'Back in Black', u'Non, je ne regrette rien', u'Dog Days Are Over',
+  u'Paint It Black', u'Bohemian Rhapsody (2011 Remaster)', u'Around the World', u'Purple Rain', u'Kickstart My Heart',
+]
+
+OPERATIONS = ['levenshtein_distance', 'fuzz', 'Term.forms', 'Term.__eq__']
+
+
+def mangle(rng, text):
+    """Make a messy variant of text, the way tags and search results differ."""
+    roll = rng.random()
+    if roll < 0.15:
+        return text.lower()
+    elif roll < 0.3:
+        return u'%s (Remastered)' % text
+    elif roll < 0.4:
+        return u'%s feat. %s' % (text, rng.choice(ARTISTS))
+    elif roll < 0.5:
+        return text.replace(u' and ', u' & ')
+    elif roll < 0.6 and len(text) > 4:
+        i = rng.randint(1, len(text) - 2)
+        return text[:i] + text[i + 1:]
+    return text
+
+
+def corpus(size, seed=1):
+    """Pairs of (artist, title) inputs and candidates, about half of them true matches."""
+    rng = random.Random(seed)
+    pairs = []
+    for _ in range(size):
+        artist = rng.choice(ARTISTS)
+        title = rng.choice(TITLES)
+        if rng.random() < 0.5:
+            candidate = (mangle(rng, artist), mangle(rng, title))
+        else:
+            candidate = (rng.choice(ARTISTS), rng.choice(TITLES))
+        pairs.append(((artist, title), candidate))
+    return pairs
+
+
+def input_rows(size, seed=1):
+    """Import rows as people type them: a few hundred tracks, each spelled several ways."""
+    rng = random.Random(seed)
+    tracks = [(rng.choice(ARTISTS), rng.choice(TITLES)) for _ in range(size // 4 or 1)]
+    rows = []
+    for _ in range(size):
+        artist, title = rng.choice(tracks)
+        rows.append((mangle(rng, artist), mangle(rng, title)))
+    return rows
+
+
+def cache_hit_rates(size, seed=1):
+    """How often an import row would find an earlier row's result under raw and canonical cache keys."""
+    import playlistcreator
+    rates = {}
+    for name, key in [('raw', playlistcreator.cache_key), ('canonical', playlistcreator.canonical_key)]:
+        seen = set()
+        hits = 0
+        for row in input_rows(size, seed):
+            row_key = key(row)
+            hits += row_key in seen
+            seen.add(row_key)
+        rates[name] = float(hits) / size
+    return rates
+
+
+def search_batches(size, seed=1, results=10):
+    """Simulated searches: an input (artist, title) and a page of candidate results to score."""
+    pairs = corpus(size * results, seed)
+    return [
+      (pairs[i][0], [candidate for _, candidate in pairs[i:i + results]])
+      for i in range(0, len(pairs), results)
+    ]
+
+
+def pool_throughput(size, processes, seed=1):
+    """Searches scored per second by PlaylistCreator.first_match in-process and in a MatchPool.
+
+    As in a concurrent import, `processes` threads each hand their searches to the pool.
+    """
+    from multiprocessing.pool import ThreadPool
+    import matchpool
+    import playlistcreator
+    batches = [
+      ((playlistcreator.Term(artist), playlistcreator.Term(title)), candidates)
+      for (artist, title), candidates in search_batches(size, seed)
+    ]
+    pc = playlistcreator.PlaylistCreator()
+    rates = {}
+    for label, workers in [('in-process', 0), ('%d processes' % processes, processes)]:
+        pool = matchpool.MatchPool(workers) if workers else None
+        score = (lambda batch: pool.first_match(*batch)) if pool else (lambda batch: pc.first_match(*batch))
+        threads = ThreadPool(max(1, processes))
+        matchpool._candidate_forms.clear()
+        started = timeit.default_timer()
+        threads.map(score, batches, chunksize=1)
+        rates[label] = len(batches) / (timeit.default_timer() - started)
+        threads.close()
+        if pool:
+            pool.close()
+    return rates
+
+
+def stub_rdioapi():
+    """Stand in for the Rdio API client, which older revisions import at module level but matching never calls."""
+    def unavailable(*args, **kwargs):
+        raise RuntimeError('rdioapi is not installed; the matching benchmark makes no API calls')
+    stub = types.ModuleType('rdioapi')
+    stub.Rdio = unavailable
+    sys.modules['rdioapi'] = stub
+
+
+def load_matching(path):
+    """Import the matching functions from the playlist_helper directory at path."""
+    sys.path.insert(0, path)
+    try:
+        imp.find_module('rdioapi')
+    except ImportError:
+        stub_rdioapi()
+    import levenshtein_distance
+    import playlistcreator
+    return {
+      'levenshtein_distance': levenshtein_distance.levenshtein_distance,
+      'fuzz': playlistcreator.fuzz,
+      'Term': playlistcreator.Term,
+    }
+
+
+def operations(matching):
+    Term = matching['Term']
+    distance = matching['levenshtein_distance']
+    fuzz = matching['fuzz']
+    return {
+      'levenshtein_distance': lambda pair: distance(pair[0][1].lower(), pair[1][1].lower()),
+      'fuzz': lambda pair: fuzz(pair[0][1], pair[1][1]),
+      'Term.forms': lambda pair: Term(pair[0][0]).forms,
+      'Term.__eq__': lambda pair: Term(pair[0][0]) == pair[1][0] and Term(pair[0][1]) == pair[1][1],
+    }
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def measure(function, pairs, repeat):
+    timer = timeit.default_timer
+    timings = []
+    for _ in range(repeat):
+        for pair in pairs:
+            started = timer()
+            function(pair)
+            timings.append(timer() - started)
+    timings.sort()
+    return {
+      'comparisons': len(timings),
+      'per_second': len(timings) / sum(timings),
+      'p50_us': percentile(timings, 0.5) * 1e6,
+      'p99_us': percentile(timings, 0.99) * 1e6,
+      'objects': object_growth(function, pairs),
+    }
+
+
+def object_growth(function, pairs):
+    """Objects left alive per comparison, from the garbage collector's count around one pass.
+
+    Python 2 has no tracemalloc, so this counts what an operation keeps
+    (caches, interned forms) rather than every allocation it makes.
+    """
+    before = tracked_objects()
+    for pair in pairs:
+        function(pair)
+    return float(tracked_objects() - before) / len(pairs)
+
+
+def tracked_objects():
+    # each collection can free more garbage or stop tracking more tuples, so collect until the count settles
+    count = None
+    while True:
+        gc.collect()
+        settled, count = count, len(gc.get_objects())
+        if count == settled:
+            return count
+
+
+def run(path, options):
+    matching = load_matching(path)
+    pairs = corpus(options['size'], options['seed'])
+    functions = operations(matching)
+    return dict((name, measure(functions[name], pairs, options['repeat'])) for name in OPERATIONS)
+
+
+def export_revision(revision, directory):
+    """Write the playlist_helper directory as of a git revision into directory."""
+    archive = subprocess.Popen(['git', 'archive', '%s:playlist_helper' % revision], cwd=os.path.dirname(_PATH), stdout=subprocess.PIPE)
+    subprocess.check_call(['tar', '-x', '-C', directory], stdin=archive.stdout)
+    if archive.wait():
+        raise subprocess.CalledProcessError(archive.returncode, 'git archive')
+
+
+def run_revision(revision, options):
+    """Benchmark the matching code from a git revision in a subprocess."""
+    workdir = tempfile.mkdtemp(prefix='playlist_helper_matching')
+    try:
+        export_revision(revision, workdir)
+        output = os.path.join(workdir, 'results.json')
+        subprocess.check_call([
+          sys.executable, os.path.realpath(__file__),
+          '--path', workdir,
+          '--size', str(options['size']),
+          '--repeat', str(options['repeat']),
+          '--seed', str(options['seed']),
+          '--json', output,
+          '--quiet',
+        ])
+        with open(output) as infile:
+            return json.load(infile)
+    finally:
+        shutil.rmtree(workdir)
+
+
+def format_results(results, baseline=None):
+    lines = ['%-22s %12s %10s %10s %10s' % ('operation', 'per second', 'p50 us', 'p99 us', 'objs/op')]
+    if baseline is not None:
+        lines[0] += ' %12s %9s' % ('base /s', 'speedup')
+    for name in OPERATIONS:
+        result = results[name]
+        line = '%-22s %12.0f %10.2f %10.2f %10.2f' % (
+          name, result['per_second'], result['p50_us'], result['p99_us'], result['objects'])
+        if baseline is not None:
+            line += ' %12.0f %8.2fx' % (baseline[name]['per_second'], result['per_second'] / baseline[name]['per_second'])
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def main(options, args):
+    baseline = None
+    if options['baseline']:
+        baseline = run_revision(options['baseline'], options)
+    results = run(options['path'], options)
+    if options['json']:
+        with open(options['json'], 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+    if not options['quiet']:
+        print format_results(results, baseline)
+        rates = cache_hit_rates(options['size'], options['seed'])
+        print '\nfound_tracks hit rate over %d import rows: raw keys %.1f%%, canonical keys %.1f%%' % (
+          options['size'], 100 * rates['raw'], 100 * rates['canonical'])
+        if options['processes']:
+            rates = pool_throughput(options['size'] // 10 or 1, options['processes'], options['seed'])
+            print '\nsearch results scored per second: %s' % ', '.join(
+              '%s %.0f' % item for item in sorted(rates.items()))
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option(
+      "-n", "--size", dest="size", type="int", default=2000,
+      help="pairs in the generated corpus", metavar="PAIRS"
+    )
+    parser.add_option(
+      "-r", "--repeat", dest="repeat", type="int", default=3,
+      help="passes over the corpus", metavar="TIMES"
+    )
+    parser.add_option("--seed", dest="seed", type="int", default=1)
+    parser.add_option(
+      "-b", "--baseline", dest="baseline", default=None,
+      help="also benchmark git REVISION and compare against it", metavar="REVISION"
+    )
+    parser.add_option(
+      "--path", dest="path", default=_PATH,
+      help="benchmark the playlist_helper code in DIRECTORY", metavar="DIRECTORY"
+    )
+    parser.add_option(
+      "--json", dest="json", default=None,
+      help="also write the results to FILE as json", metavar="FILE"
+    )
+    parser.add_option(
+      "-p", "--processes", dest="processes", type="int", default=0,
+      help="also compare scoring search results in-process and in a pool of PROCESSES", metavar="PROCESSES"
+    )
+    parser.add_option("-q", "--quiet", dest="quiet", action="store_true", default=False)
+    (options, args) = parser.parse_args()
+    options = options.__dict__
+    main(options, args)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""Compare the memory held by raw API track dicts and by compact Track records."""
+import json
+import sys
+import time
+from optparse import OptionParser
+
+from fakerdio import FakeRdio
+from tracks import Track, compact_tracks
+
+# fields a real Rdio track carried besides the ones fakerdio generates
+API_FIELDS = {
+  'albumArtist': None,
+  'albumArtistKey': None,
+  'artistUrl': '/artist/%(artistKey)s/',
+  'albumUrl': '/artist/%(artistKey)s/album/%(albumKey)s/',
+  'icon': 'http://img02.cdn2-rdio.com/album/%(albumKey)s/square-200.jpg',
+  'icon400': 'http://img02.cdn2-rdio.com/album/%(albumKey)s/square-400.jpg',
+  'shortUrl': 'http://rd.io/x/%(key)s/',
+  'embedUrl': 'https://rd.io/e/%(key)s/',
+  'canStream': True,
+  'canSample': True,
+  'isExplicit': False,
+  'isClean': False,
+  'price': None,
+}
+
+
+def api_tracks(size):
+    """Tracks the way the paginators got them: freshly decoded json, so nothing is shared."""
+    client = FakeRdio(tracks=size, playlists=0, favorites=0, comments=0)
+    items = []
+    for track in client.tracks[:size]:
+        item = dict(track)
+        for field, value in API_FIELDS.items():
+            if field == 'albumArtist':
+                value = track['artist']
+            elif field == 'albumArtistKey':
+                value = track['artistKey']
+            elif isinstance(value, basestring):
+                value = value % track
+            item[field] = value
+        items.append(item)
+    return json.loads(json.dumps(items))
+
+
+def deep_size(obj, seen=None):
+    """Bytes held by obj and everything it refers to, counting shared objects once."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(key, seen) + deep_size(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif isinstance(obj, Track):
+        size += sum(deep_size(getattr(obj, field), seen) for field in Track.__slots__ if hasattr(obj, field))
+    return size
+
+
+def measure(size):
+    items = api_tracks(size)
+    raw = deep_size(items)
+    strings = {}
+    started = time.time()
+    compact = compact_tracks(items, strings)
+    seconds = time.time() - started
+    # the strings kept alive only by the intern table belong to the compact side too
+    compact_bytes = deep_size(compact) + deep_size(strings, set(id(track) for track in compact))
+    cached = [Track.from_api(item, extras=False) for item in items]
+    return {
+      'tracks': size,
+      'raw_bytes': raw,
+      'compact_bytes': compact_bytes,
+      'cached_bytes': deep_size(cached),
+      'convert_seconds': seconds,
+    }
+
+
+def format_results(results):
+    lines = ['%8s %12s %12s %12s %10s %8s' % ('tracks', 'raw B/trk', 'compact B/trk', 'cached B/trk', 'saved', 'conv s')]
+    for result in results:
+        size = result['tracks']
+        lines.append('%8d %12.0f %13.0f %12.0f %9.0f%% %8.3f' % (
+          size, float(result['raw_bytes']) / size, float(result['compact_bytes']) / size,
+          float(result['cached_bytes']) / size, 100 - 100.0 * result['compact_bytes'] / result['raw_bytes'],
+          result['convert_seconds']))
+    return '\n'.join(lines)
+
+
+def main(options, args):
+    results = [measure(int(size)) for size in options['sizes'].split(',')]
+    print format_results(results)
+    if options['json']:
+        with open(options['json'], 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option(
+      "-s", "--sizes", dest="sizes", default="1000,10000,100000",
+      help="comma separated numbers of tracks", metavar="SIZES"
+    )
+    parser.add_option(
+      "--json", dest="json", default=None,
+      help="also write the results to FILE as json", metavar="FILE"
+    )
+    (options, args) = parser.parse_args()
+    options = options.__dict__
+    main(options, args)
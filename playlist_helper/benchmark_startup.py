@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""Time how long each command line tool takes to start up and finish a trivial job."""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+from benchmark_matching import export_revision
+
+_PATH = os.path.dirname(os.path.realpath(__file__))
+
+# every command runs without touching the network: dry runs, or just --help for dump.py
+COMMANDS = [
+  ('ids.py', ['--dry-run', '-n', 'startup', '1', '2', '3']),
+  ('txt.py', ['--dry-run', 'startup.txt']),
+  ('m3u.py', ['--dry-run', 'startup.m3u']),
+  ('dump.py', ['--help']),
+]
+
+
+def time_command(path, script, arguments, repeat, workdir):
+    """Run a tool `repeat` times in workdir and return the sorted wall times."""
+    timings = []
+    command = [sys.executable, os.path.join(path, script)] + arguments
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            started = time.time()
+            subprocess.check_call(command, cwd=workdir, stdout=devnull, stderr=devnull)
+            timings.append(time.time() - started)
+    return sorted(timings)
+
+
+def run(path, repeat):
+    workdir = tempfile.mkdtemp(prefix='playlist_helper_startup')
+    try:
+        with open(os.path.join(workdir, 'startup.txt'), 'w') as outfile:
+            outfile.write('Godley & Creme\tFreeze Frame\tSnack Attack\n')
+        with open(os.path.join(workdir, 'startup.m3u'), 'w') as outfile:
+            outfile.write('#EXTM3U\n')
+        results = {}
+        for script, arguments in COMMANDS:
+            timings = time_command(path, script, arguments, repeat, workdir)
+            results[script] = {
+              'min_ms': timings[0] * 1000,
+              'median_ms': timings[len(timings) // 2] * 1000,
+            }
+        return results
+    finally:
+        shutil.rmtree(workdir)
+
+
+def format_results(results, baseline=None):
+    lines = ['%-10s %10s %10s' % ('command', 'min ms', 'median ms')]
+    if baseline is not None:
+        lines[0] += ' %14s %10s' % ('base median ms', 'change')
+    for script, _ in COMMANDS:
+        result = results[script]
+        line = '%-10s %10.1f %10.1f' % (script, result['min_ms'], result['median_ms'])
+        if baseline is not None:
+            base = baseline[script]['median_ms']
+            line += ' %14.1f %9.0f%%' % (base, 100 * (result['median_ms'] - base) / base)
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def main(options, args):
+    baseline = None
+    if options['baseline']:
+        revision_dir = tempfile.mkdtemp(prefix='playlist_helper_revision')
+        try:
+            export_revision(options['baseline'], revision_dir)
+            baseline = run(revision_dir, options['repeat'])
+        finally:
+            shutil.rmtree(revision_dir)
+    results = run(_PATH, options['repeat'])
+    print format_results(results, baseline)
+    if options['json']:
+        with open(options['json'], 'w') as outfile:
+            json.dump({'results': results, 'baseline': baseline}, outfile, indent=2)
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option(
+      "-r", "--repeat", dest="repeat", type="int", default=10,
+      help="runs of each command", metavar="TIMES"
+    )
+    parser.add_option(
+      "-b", "--baseline", dest="baseline", default=None,
+      help="also time the tools from git REVISION (which must support --dry-run) and compare", metavar="REVISION"
+    )
+    parser.add_option(
+      "--json", dest="json", default=None,
+      help="also write the results to FILE as json", metavar="FILE"
+    )
+    (options, args) = parser.parse_args()
+    options = options.__dict__
+    main(options, args)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""Time dump_playlist writing xspf, jspf, csv and m3u files with different numbers of writer threads."""
+import codecs
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+import dump
+from fakerdio import FakeRdio
+from playlistcreator import PlaylistCreator
+from writerpool import WriterPool
+
+
+def fetch_playlists(options):
+    """Every playlist of a FakeRdio account, tracks included, as dump_user gets them."""
+    client = FakeRdio(
+      tracks=options['tracks'],
+      playlists=options['playlists'],
+      playlist_length=options['playlist_length'],
+      favorites=options['playlist_length'],
+      comments=0,
+    )
+    pc = PlaylistCreator(client=client)
+    stdout = sys.stdout
+    # the paging loop prints progress, including unicode playlist names
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = codecs.getwriter('utf-8')(devnull)
+        try:
+            return pc.current_user(), list(pc.list_playlists(pc.current_user()))
+        finally:
+            sys.stdout = stdout
+            pc.close()
+
+
+def measure(user, playlists, threads):
+    """Dump every playlist into a scratch folder with a WriterPool of `threads`."""
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='playlist_helper_writing')
+    os.chdir(workdir)
+    try:
+        user = dict(user, _playlists=set())
+        writer = WriterPool(threads)
+        started = time.time()
+        for playlist in playlists:
+            dump.dump_playlist(user, playlist, writer)
+        writer.close()
+        seconds = time.time() - started
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+    return {
+      'threads': threads,
+      'files': writer.files,
+      'bytes': writer.bytes,
+      'seconds': seconds,
+      'files_per_second': writer.files / seconds,
+      'mb_per_second': writer.bytes / seconds / 1e6,
+    }
+
+
+def format_results(results):
+    lines = ['%8s %8s %10s %9s %10s %8s' % ('threads', 'files', 'MB', 'seconds', 'files/s', 'MB/s')]
+    for result in results:
+        lines.append('%8d %8d %10.1f %9.3f %10.0f %8.1f' % (
+          result['threads'], result['files'], result['bytes'] / 1e6, result['seconds'],
+          result['files_per_second'], result['mb_per_second']))
+    return '\n'.join(lines)
+
+
+def main(options, args):
+    user, playlists = fetch_playlists(options)
+    results = []
+    for threads in options['threads'].split(','):
+        # best of a few runs, so a cold page cache doesn't decide the result
+        runs = [measure(user, playlists, int(threads)) for _ in range(options['repeat'])]
+        results.append(min(runs, key=lambda run: run['seconds']))
+    print format_results(results)
+    if options['json']:
+        with open(options['json'], 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option(
+      "-t", "--threads", dest="threads", default="0,1,2,4,8",
+      help="comma separated writer thread counts; 0 writes each file as it is rendered", metavar="COUNTS"
+    )
+    parser.add_option("--tracks", dest="tracks", type="int", default=5000, help="tracks in the catalog")
+    parser.add_option("--playlists", dest="playlists", type="int", default=100, help="playlists in the account")
+    parser.add_option(
+      "--playlist-length", dest="playlist_length", type="int", default=200, help="tracks per playlist"
+    )
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=3, help="runs per thread count")
+    parser.add_option(
+      "--json", dest="json", default=None,
+      help="also write the results to FILE as json", metavar="FILE"
+    )
+    (options, args) = parser.parse_args()
+    options = options.__dict__
+    main(options, args)
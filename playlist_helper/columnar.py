@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""One columnar file per user holding every playlist track row, and a memory-mapped reader for it.
+
+The file is written as playlists arrive, in row groups of ROW_GROUP_SIZE rows.
+Each row group stores each column contiguously: string columns as a table of
+distinct utf-8 values plus a little-endian uint32 index per row, int columns
+as little-endian int32 (-1 for missing). A json footer records where every
+column chunk is:
+
+    MAGIC, row group, row group, ..., footer json, uint64 footer length, MAGIC
+
+Reading a column touches only that column's chunks of the mapped file.
+
+    python playlist_helper/columnar.py dumps/jmullan/playlist_tracks.col --top 20
+"""
+import json
+import mmap
+import struct
+import sys
+from array import array
+from optparse import OptionParser
+
+MAGIC = 'PHCOL1\n'
+ROW_GROUP_SIZE = 4096
+
+COLUMNS = [
+  ('playlist_key', 'str'),
+  ('playlist_type', 'str'),
+  ('position', 'int'),
+  ('key', 'str'),
+  ('artist', 'str'),
+  ('album', 'str'),
+  ('name', 'str'),
+  ('duration', 'int'),
+  ('trackNum', 'int'),
+  ('isrc', 'str'),
+]
+COLUMN_TYPES = dict(COLUMNS)
+
+_FOOTER_LENGTH = struct.Struct('<Q')
+
+
+def _little_endian(values):
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def _encode_strings(values):
+    """Dictionary-encode a chunk of strings: the distinct values, then one index per row."""
+    positions = {}
+    table = []
+    indexes = array('I')
+    for value in values:
+        index = positions.get(value)
+        if index is None:
+            index = positions[value] = len(table)
+            table.append(value)
+        indexes.append(index)
+    parts = [struct.pack('<I', len(table))]
+    for value in table:
+        encoded = value.encode('utf-8')
+        parts.append(struct.pack('<I', len(encoded)))
+        parts.append(encoded)
+    parts.append(_little_endian(indexes).tostring())
+    return ''.join(parts)
+
+
+def _decode_strings(data):
+    (count,) = struct.unpack_from('<I', data, 0)
+    offset = 4
+    table = []
+    for _ in range(count):
+        (length,) = struct.unpack_from('<I', data, offset)
+        offset += 4
+        table.append(data[offset:offset + length].decode('utf-8'))
+        offset += length
+    indexes = _little_endian(array('I', data[offset:]))
+    return [table[index] for index in indexes]
+
+
+def _encode_ints(values):
+    return _little_endian(array('i', [-1 if value is None else int(value) for value in values])).tostring()
+
+
+def _decode_ints(data):
+    return [None if value == -1 else value for value in _little_endian(array('i', data))]
+
+
+def playlist_rows(playlist_key, playlist):
+    """The rows for one playlist, one per track in order."""
+    for position, track in enumerate(playlist['tracks']):
+        isrcs = track.get('isrcs') or []
+        yield {
+          'playlist_key': playlist_key,
+          'playlist_type': playlist['playlist_type'],
+          'position': position,
+          'key': track.get('key') or u'',
+          'artist': track.get('artist') or u'',
+          'album': track.get('album') or u'',
+          'name': track.get('name') or u'',
+          'duration': track.get('duration'),
+          'trackNum': track.get('trackNum'),
+          'isrc': isrcs[0] if isrcs else u'',
+        }
+
+
+class ColumnarWriter(object):
+    """Stream rows into a columnar file, a row group at a time."""
+
+    def __init__(self, filename, row_group_size=ROW_GROUP_SIZE):
+        self.filename = filename
+        self.row_group_size = row_group_size
+        self.rows = 0
+        self._outfile = open(filename, 'wb')
+        self._outfile.write(MAGIC)
+        self._offset = len(MAGIC)
+        self._buffer = dict((name, []) for name, _ in COLUMNS)
+        self._buffered = 0
+        self._row_groups = []
+
+    def write_row(self, row):
+        for name, _ in COLUMNS:
+            self._buffer[name].append(row[name])
+        self._buffered += 1
+        self.rows += 1
+        if self._buffered >= self.row_group_size:
+            self.flush()
+
+    def write_playlist(self, playlist_key, playlist):
+        for row in playlist_rows(playlist_key, playlist):
+            self.write_row(row)
+
+    def flush(self):
+        """Write the buffered rows out as one row group."""
+        if not self._buffered:
+            return
+        chunks = {}
+        for name, kind in COLUMNS:
+            values = self._buffer[name]
+            data = _encode_strings(values) if kind == 'str' else _encode_ints(values)
+            self._outfile.write(data)
+            chunks[name] = [self._offset, len(data)]
+            self._offset += len(data)
+            del values[:]
+        self._row_groups.append({'rows': self._buffered, 'columns': chunks})
+        self._buffered = 0
+
+    def close(self):
+        if self._outfile is None:
+            return
+        self.flush()
+        footer = json.dumps({'columns': COLUMNS, 'rows': self.rows, 'row_groups': self._row_groups})
+        self._outfile.write(footer)
+        self._outfile.write(_FOOTER_LENGTH.pack(len(footer)))
+        self._outfile.write(MAGIC)
+        self._outfile.close()
+        self._outfile = None
+
+
+class ColumnarFile(object):
+    """Read columns from a file written by ColumnarWriter through a memory map."""
+
+    def __init__(self, filename):
+        self._infile = open(filename, 'rb')
+        self._map = mmap.mmap(self._infile.fileno(), 0, access=mmap.ACCESS_READ)
+        end = len(self._map) - len(MAGIC)
+        if self._map[:len(MAGIC)] != MAGIC or self._map[end:] != MAGIC:
+            raise ValueError('Not a playlist_helper columnar file: %s' % filename)
+        (length,) = _FOOTER_LENGTH.unpack(self._map[end - _FOOTER_LENGTH.size:end])
+        start = end - _FOOTER_LENGTH.size - length
+        footer = json.loads(self._map[start:start + length])
+        self.columns = [name for name, _ in footer['columns']]
+        self.rows = footer['rows']
+        self._row_groups = footer['row_groups']
+
+    def close(self):
+        self._map.close()
+        self._infile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def column(self, name):
+        """Every value of one column, in row order."""
+        decode = _decode_strings if COLUMN_TYPES[name] == 'str' else _decode_ints
+        values = []
+        for row_group in self._row_groups:
+            offset, length = row_group['columns'][name]
+            values.extend(decode(self._map[offset:offset + length]))
+        return values
+
+    def iter_rows(self, columns=None):
+        """Yield rows as dicts of the requested columns."""
+        columns = columns or self.columns
+        data = [self.column(name) for name in columns]
+        for values in zip(*data):
+            yield dict(zip(columns, values))
+
+    def top_tracks(self, count=10):
+        """The tracks that appear in the most playlists, as (playlists, key, artist, name) rows."""
+        playlists = {}
+        names = {}
+        for playlist_key, key, artist, name in zip(
+          self.column('playlist_key'), self.column('key'), self.column('artist'), self.column('name')):
+            playlists.setdefault(key, set()).add(playlist_key)
+            names[key] = (artist, name)
+        ranked = sorted(playlists.items(), key=lambda item: (-len(item[1]), item[0]))[:count]
+        return [(len(keys), key) + names[key] for key, keys in ranked]
+
+
+def main(options, args):
+    for filename in args:
+        with ColumnarFile(filename) as columnar:
+            print '%s: %d rows' % (filename, columnar.rows)
+            for playlists, key, artist, name in columnar.top_tracks(options['top']):
+                print (u'%5d  %-10s %s - %s' % (playlists, key, artist, name)).encode('utf-8')
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage='%prog [options] FILE...')
+    parser.add_option(
+      "-t", "--top", dest="top", type="int", default=10,
+      help="show the COUNT tracks found in the most playlists", metavar="COUNT"
+    )
+    (options, args) = parser.parse_args()
+    options = options.__dict__
+    main(options, args)
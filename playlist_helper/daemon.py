@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""Keep one warm PlaylistCreator in a background process and run tool jobs sent over a unix socket.
+
+    python playlist_helper/daemon.py serve &
+    python playlist_helper/daemon.py txt --dry-run playlist.txt
+    python playlist_helper/daemon.py stop
+"""
+import json
+import logging
+import os
+import socket
+import SocketServer
+import sys
+from optparse import OptionParser
+
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+TOOLS = ['dump', 'ids', 'jobqueue', 'm3u', 'txt']
+DEFAULT_SOCKET = os.path.expanduser('~/.playlist_helper.sock')
+CONNECT_TIMEOUT = 10.0
+
+
+def load_tool(command):
+    if command not in TOOLS:
+        raise ValueError('Unknown command: %s' % command)
+    return __import__(command)
+
+
+class Output(object):
+    """A file-like buffer for what a job prints, kept as utf-8."""
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self._parts.append(data)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return ''.join(self._parts).decode('utf-8', 'replace')
+
+
+class captured_output(object):
+    """Send stdout, stderr and log records to buffers for the length of a job."""
+
+    def __enter__(self):
+        self.stdout = Output()
+        self.stderr = Output()
+        self._handler = logging.StreamHandler(self.stderr)
+        self._handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        logging.getLogger().addHandler(self._handler)
+        self._streams = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+        return self
+
+    def __exit__(self, *exc_info):
+        sys.stdout, sys.stderr = self._streams
+        logging.getLogger().removeHandler(self._handler)
+
+
+class JobHandler(SocketServer.StreamRequestHandler):
+    """Read one json job per connection and answer with one json line."""
+
+    def handle(self):
+        try:
+            job = json.loads(self.rfile.readline())
+        except ValueError:
+            response = {'ok': False, 'error': 'Could not parse the job'}
+        else:
+            response = self.server.run_job(job)
+        self.wfile.write(json.dumps(response) + '\n')
+
+
+class JobServer(SocketServer.UnixStreamServer):
+    """Runs jobs one at a time against a single PlaylistCreator.
+
+    The shelves, the OAuth session, the keep-alive connections and the
+    found_tracks cache all stay open between jobs.
+    """
+
+    def __init__(self, path, pc):
+        if os.path.exists(path):
+            os.unlink(path)
+        SocketServer.UnixStreamServer.__init__(self, path, JobHandler)
+        os.chmod(path, 0600)
+        self.path = path
+        self.pc = pc
+        self.stopped = False
+
+    def run_job(self, job):
+        """Run one job, answering with what it printed and logged as `output` and `log`."""
+        command = job.get('command')
+        if command == 'ping':
+            return {'ok': True}
+        if command == 'stop':
+            self.stopped = True
+            return {'ok': True}
+        cwd = os.getcwd()
+        response = {'ok': True}
+        with captured_output() as captured:
+            try:
+                tool = load_tool(command)
+                (options, args) = tool.make_parser().parse_args(job.get('argv', []))
+                options = options.__dict__
+                os.chdir(job.get('cwd') or cwd)
+                # every job gets its own report, but shares the caches, the session and the connections
+                self.pc.reset_stats()
+                self.pc.dry_run = bool(options.get('dry_run'))
+                # the session can expire or be revoked while the daemon runs
+                if not self.pc.dry_run and not self.pc.authenticated:
+                    raise ValueError('You need to authenticate by running `python playlist_helper/authenticate.py` first')
+                tool.main(options, args, pc=self.pc)
+            except (Exception, SystemExit) as ex:
+                logger.exception('Job failed: %s', command)
+                response = {'ok': False, 'error': str(ex)}
+            finally:
+                os.chdir(cwd)
+        response['output'] = captured.stdout.getvalue()
+        response['log'] = captured.stderr.getvalue()
+        return response
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def serve(path):
+    from playlistcreator import PlaylistCreator
+    pc = PlaylistCreator()
+    pc.open()
+    if not pc.authenticated:
+        logger.error('You need to authenticate by running `python playlist_helper/authenticate.py` first')
+        sys.exit(1)
+    server = JobServer(path, pc)
+    logger.info('Listening on %s', path)
+    try:
+        while not server.stopped:
+            server.handle_request()
+    finally:
+        server.server_close()
+        pc.close()
+
+
+def send(path, job, timeout=None):
+    """Send a job to a running daemon and return its response, waiting at most `timeout` seconds for it."""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.settimeout(CONNECT_TIMEOUT)
+        client.connect(path)
+        client.sendall(json.dumps(job) + '\n')
+        client.settimeout(timeout)
+        return json.loads(client.makefile('r').readline())
+    finally:
+        client.close()
+
+
+def main(options, args):
+    if not args:
+        logger.error('Usage: daemon.py [--socket PATH] serve|stop|ping|%s [ARGS...]', '|'.join(TOOLS))
+        sys.exit(1)
+    command = args[0]
+    if command == 'serve':
+        serve(options['socket'])
+        return
+    job = {'command': command, 'argv': args[1:], 'cwd': os.getcwd()}
+    try:
+        response = send(options['socket'], job, options['timeout'])
+    except socket.timeout:
+        logger.error('No answer from the daemon on %s within %s seconds', options['socket'], options['timeout'])
+        sys.exit(1)
+    except socket.error as ex:
+        logger.error('Could not reach the daemon on %s: %s', options['socket'], ex)
+        sys.exit(1)
+    sys.stdout.write(response.get('output', '').encode('utf-8'))
+    sys.stderr.write(response.get('log', '').encode('utf-8'))
+    if not response['ok']:
+        logger.error(response['error'])
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option(
+      "-s", "--socket", dest="socket", default=DEFAULT_SOCKET,
+      help="unix socket the daemon listens on", metavar="PATH"
+    )
+    parser.add_option(
+      "-t", "--timeout", dest="timeout", type="float", default=3600.0,
+      help="give up waiting for a job's answer after SECONDS", metavar="SECONDS"
+    )
+    # everything after the command belongs to the tool
+    parser.disable_interspersed_args()
+    (options, args) = parser.parse_args()
+    options = options.__dict__
+    main(options, args)
@@ -9,15 +9,24 @@ import pprint
 import re
 import string
 import sys
+import time
 import urllib
+from cStringIO import StringIO
 from optparse import OptionParser
 
+from archive import SHARED_TRACKS, TRACKS, ArchiveWriter, TrackTable, playlist_digests
+from columnar import ColumnarWriter
 from contrib import xspf
+from metrics import write_report
 from playlistcreator import PlaylistCreator
+from profiling import add_options as add_profiling_options, profiling
+from writerpool import WriterPool, write_atomic
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 
+PLAYLIST_HASHES = 'playlist_hashes.json'
+
 
 def convert_track(track):
     """Turn a requested track into something for jspf."""
@@ -86,12 +95,22 @@ def _meta(key):
     return 'https://rdio.com/xspf/%s' % urllib.quote(key)
 
 
-def dump_playlist(user, playlist):
-    """Given a user and playlist, dump that playlist into csv and jspf files."""
-    if not playlist['tracks']:
-        print 'No tracks for %s' % playlist['name']
-        return
+def render_xspf(playlist):
+    x = xspf.Xspf()
+    x.title = playlist['name']
+    x.annotation = playlist.get('description', '')
+    x.creator = playlist['owner']
+    for key, value in playlist.items():
+        if key not in ['tracks']:
+            x.add_meta(_meta(key), unicode(value))
 
+    for track in playlist['tracks']:
+        xtrack = xspf_track(track)
+        x.add_track(xtrack)
+    return x.toXml().decode('utf-8', 'ignore').encode('utf-8')
+
+
+def render_jspf(playlist):
     jspf_structure = {
       "playlist": {
         "title": playlist['name'],
@@ -106,21 +125,51 @@ def dump_playlist(user, playlist):
         ]
       }
     }
-    playlist_folder = '%s/' % playlist['playlist_type']
-    playlist_folder = 'dumps/%s/playlists/%s' % (user['username'], playlist_folder)
-    makedirs(playlist_folder)
+    return json.dumps(jspf_structure, indent=2)
 
-    x = xspf.Xspf()
-    x.title = playlist['name']
-    x.annotation = playlist.get('description', '')
-    x.creator = playlist['owner']
-    for key, value in playlist.items():
-        if key not in ['tracks']:
-            x.add_meta(_meta(key), unicode(value))
 
+def render_csv(playlist):
+    outfile = StringIO()
+    csv_writer = csv.writer(outfile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
     for track in playlist['tracks']:
-        xtrack = xspf_track(track)
-        x.add_track(xtrack)
+        track = [track[key].encode('ascii', 'ignore') for key in ['artist', 'album', 'name']]
+        try:
+            csv_writer.writerow(track)
+        except Exception:
+            print track
+            raise
+    return outfile.getvalue()
+
+
+def render_m3u(playlist):
+    # m3u files are supposed to be cp1252: https://en.wikipedia.org/wiki/M3U
+    lines = [u'#EXTM3U\n']
+    for track in playlist['tracks']:
+        lines.append(u'#EXTINF:%s,%s - %s\n' % ((track['duration'] or 0) * 1000, track['artist'], track['name']))
+        lines.append(u'%s/%s/%s - %s.mp3\n' % (track['artist'], track['album'], track['trackNum'], track['name']))
+    return u''.join(lines).encode('cp1252', 'ignore')
+
+
+RENDERERS = [
+  ('xspf', render_xspf),
+  ('jspf', render_jspf),
+  ('csv', render_csv),
+  ('m3u', render_m3u),
+]
+
+
+def dump_playlist(user, playlist, writer=None):
+    """Given a user and playlist, dump that playlist into xspf, jspf, csv and m3u files.
+
+    The files are written by `writer`, a WriterPool, or right away without one.
+    """
+    if not playlist['tracks']:
+        print 'No tracks for %s' % playlist['name']
+        return
+
+    playlist_folder = '%s/' % playlist['playlist_type']
+    playlist_folder = 'dumps/%s/playlists/%s' % (user['username'], playlist_folder)
+    makedirs(playlist_folder)
 
     playlist_name = playlist_slug(playlist)
     if not playlist_name or playlist_name in user['_playlists']:
@@ -133,33 +182,14 @@ def dump_playlist(user, playlist):
         pprint.pprint(playlist)
         exit(1)
 
-    playlist_filename = '%s%s.xspf' % (playlist_folder, playlist_name)
-    with codecs.open(playlist_filename, 'w', 'utf-8', 'ignore') as outfile:
-        xml = x.toXml().decode('utf-8', errors='ignore')
-        outfile.write(xml)
+    fields = [(key, value) for key, value in playlist.items() if key != 'tracks']
+    track_keys = [track.get('key') or u'%s - %s' % (track['artist'], track['name']) for track in playlist['tracks']]
+    user.setdefault('_hashes', {})['%s%s.jspf' % (playlist_folder, playlist_name)] = playlist_digests(fields, track_keys)
 
-    playlist_filename = '%s%s.jspf' % (playlist_folder, playlist_name)
-    with codecs.open(playlist_filename, 'w', 'utf-8', 'ignore') as outfile:
-        json.dump(jspf_structure, outfile, indent=2)
-
-    playlist_filename = '%s%s.csv' % (playlist_folder, playlist_name)
-    with codecs.open(playlist_filename, 'w', 'utf-8', 'ignore') as outfile:
-        csv_writer = csv.writer(outfile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        for track in playlist['tracks']:
-            track = [track[key].encode('ascii', 'ignore') for key in ['artist', 'album', 'name']]
-            try:
-                csv_writer.writerow(track)
-            except Exception:
-                print track
-                raise
-
-    playlist_filename = '%s%s.m3u' % (playlist_folder, playlist_name)
-    with codecs.open(playlist_filename, 'w', 'cp1252', 'ignore') as outfile:
-        # m3u files are supposed to be cp1252: https://en.wikipedia.org/wiki/M3U
-        outfile.write('#EXTM3U\n')
-        for track in playlist['tracks']:
-            outfile.write('#EXTINF:%s,%s - %s\n' % ((track['duration'] or 0) * 1000, track['artist'], track['name']))
-            outfile.write('%s/%s/%s - %s.mp3\n' % (track['artist'], track['album'], track['trackNum'], track['name']))
+    if writer is None:
+        writer = WriterPool(0)
+    for extension, render in RENDERERS:
+        writer.submit('%s%s.%s' % (playlist_folder, playlist_name, extension), render, playlist)
 
 
 def simplify_comment(comment):
@@ -243,19 +273,205 @@ def dump_iterable(user, name, items):
         json.dump(structure, outfile, indent=2)
 
     filename = 'dumps/%s/%s.csv' % (user['username'], name)
-    with codecs.open(filename, 'w', 'utf-8') as outfile:
+    # the csv module writes bytes, so encode the rows rather than the stream
+    with open(filename, 'wb') as outfile:
         csv_writer = csv.writer(outfile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
         for item in items:
             item = item.encode('utf8', 'ignore')
             csv_writer.writerow([item])
 
 
-def main(options, args):
+def close_all(closers):
+    """Call every closer, even after one fails, then raise the first error."""
+    exc_info = None
+    for close in closers:
+        try:
+            close()
+        except Exception:
+            if exc_info is None:
+                exc_info = sys.exc_info()
+            else:
+                logger.exception('Another error while closing')
+    if exc_info is not None:
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+
+def dump_user(pc, user, archive=False, shared_tracks=None):
+    """Dump everything we can get for one user.
+
+    With `archive`, playlists go into a compressed archive instead of the
+    per-playlist files, their tracks into `shared_tracks` or a table of the user's own.
+    """
+    makedirs('dumps/%s' % user['username'])
+    with pc.metrics.phase('fetch'):
+        comments = pc.list_comments(user)
+        favorites = [
+          ('favorite_artists', list(pc.get_favorite_artists(user))),
+          ('favorite_labels', list(pc.get_favorite_labels(user))),
+          ('favorite_stations', list(pc.get_favorite_stations(user))),
+        ]
+    with pc.metrics.phase('write'):
+        dump_comments(user, comments)
+        for name, items in favorites:
+            dump_iterable(user, name, items)
+
+    user['_playlists'] = set()
+    playlists = pc.list_playlists(user)
+    # every playlist's tracks also go into one columnar file for analysis
+    columnar = ColumnarWriter('dumps/%s/playlist_tracks.col' % user['username'])
+    closers = [columnar.close]
+    archive_writer = tracks = writer = None
+    if archive:
+        folder = 'dumps/%s/archive' % user['username']
+        makedirs(folder)
+        tracks = shared_tracks or TrackTable('%s/%s' % (folder, TRACKS))
+        archive_writer = ArchiveWriter(folder, user['username'], tracks)
+        closers.append(archive_writer.close)
+        if tracks is not shared_tracks:
+            closers.append(tracks.close)
+    else:
+        writer = WriterPool(pc.setting('write_threads', 4))
+
+        def finish_writes():
+            # wait for the files still being written
+            with pc.metrics.phase('write'):
+                writer.close()
+        closers.insert(0, finish_writes)
+    try:
+        while True:
+            with pc.metrics.phase('fetch'):
+                playlist = next(playlists, None)
+            if playlist is None:
+                break
+            with pc.metrics.phase('write'):
+                if archive_writer is not None:
+                    archive_writer.write_playlist(playlist)
+                else:
+                    dump_playlist(user, playlist, writer)
+                columnar.write_playlist(playlist.get('key') or playlist_slug(playlist), playlist)
+    except BaseException:
+        exc_info = sys.exc_info()
+        try:
+            close_all(closers)
+        except Exception:
+            # the error that stopped the dump is the one to report
+            logger.exception('Could not close the dump files for %s', user['username'])
+        raise exc_info[0], exc_info[1], exc_info[2]
+    close_all(closers)
+    if archive_writer is not None:
+        logger.info('Archived %d playlists for %s: %d track references, %d new track records',
+                    archive_writer.playlists, user['username'], tracks.references, tracks.written)
+    if writer is not None:
+        write_playlist_hashes(user)
+
+
+def write_playlist_hashes(user):
+    """Record each dumped playlist's track and field hashes, so dumpdiff.py only has to read the changed ones."""
+    playlists_folder = 'dumps/%s/playlists' % user['username']
+    hashes = dict(
+      (os.path.relpath(filename, playlists_folder), {'tracks': tracks_digest, 'meta': meta_digest})
+      for filename, (tracks_digest, meta_digest) in user.get('_hashes', {}).items()
+    )
+    write_atomic('dumps/%s/%s' % (user['username'], PLAYLIST_HASHES), json.dumps(hashes, indent=2, sort_keys=True))
+
+
+def read_identifiers(filename):
+    """Read one user key, email or username per line, skipping blanks and # comments."""
+    with open(filename) as infile:
+        for line in infile:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+
+
+def dump_users(pc, identifiers, archive=False, shared_tracks=None):
+    """Dump many users with one shared client, isolating each user's failures.
+
+    Returns one summary row per identifier with its status, time and request count.
+    Identifiers naming an account already listed are reported as duplicates
+    and not dumped again, since both dumps would write the same files.
+    """
+    pc.rdio.thread_calls()
+    resolved = pc.get_users(identifiers)
+    lookup_calls = pc.rdio.thread_calls()
+    logger.info('Looked up %d users in %d requests', len(resolved), lookup_calls)
+    seen = set()
+    items = []
+    for identifier, user, error in resolved:
+        duplicate = user is not None and user['key'] in seen
+        if user is not None:
+            seen.add(user['key'])
+        items.append((identifier, user, error, duplicate))
+
+    def dump_one(item):
+        identifier, user, error, duplicate = item
+        summary = {'identifier': identifier, 'username': None, 'status': 'ok', 'seconds': 0.0, 'requests': 0}
+        if error is not None:
+            summary['status'] = 'failed: lookup: %s' % (error,)
+            return summary
+        if user is None:
+            summary['status'] = 'not found'
+            return summary
+        summary['username'] = user['username']
+        if duplicate:
+            summary['status'] = 'duplicate of %s' % user['key']
+            return summary
+        pc.rdio.thread_calls()
+        started = time.time()
+        try:
+            dump_user(pc, user, archive, shared_tracks)
+        except (Exception, SystemExit) as ex:
+            # one broken account should not stop the rest of the archive
+            logger.exception('Failed to dump %s', identifier)
+            summary['status'] = 'failed: %s' % (ex,)
+        summary['seconds'] = time.time() - started
+        summary['requests'] = pc.rdio.thread_calls()
+        return summary
+
+    return pc.map(dump_one, items)
+
+
+def format_summary(summaries):
+    """Render dump_users results as a table."""
+    lines = ['%-30s %-30s %8s %8s  %s' % ('identifier', 'username', 'seconds', 'requests', 'status')]
+    for summary in summaries:
+        lines.append('%-30s %-30s %8.1f %8d  %s' % (
+          summary['identifier'], summary['username'] or '-', summary['seconds'], summary['requests'], summary['status']))
+    return '\n'.join(lines)
+
+
+def open_shared_tracks(options):
+    """The track table shared by every user's archive, if --archive and --shared-tracks are set."""
+    if not (options.get('archive') and options.get('shared_tracks')):
+        return None
+    makedirs('dumps')
+    return TrackTable(SHARED_TRACKS, append=True)
+
+
+def main(options, args, pc=None):
     """Run all the things."""
-    pc = PlaylistCreator()
-    if not pc.authenticated:
-        logger.error('You need to authenticate by running `python playlist_helper/authenticate.py` first')
-        sys.exit(1)
+    if pc is None:
+        pc = PlaylistCreator()
+        if not pc.authenticated:
+            logger.error('You need to authenticate by running `python playlist_helper/authenticate.py` first')
+            sys.exit(1)
+
+    archive = options.get('archive')
+    if options.get('users_file'):
+        shared_tracks = open_shared_tracks(options)
+        try:
+            with profiling(pc, options):
+                summaries = dump_users(pc, list(read_identifiers(options['users_file'])), archive, shared_tracks)
+        finally:
+            if shared_tracks is not None:
+                shared_tracks.close()
+        print format_summary(summaries)
+        logger.info(pc.format_api_stats())
+        report = pc.run_report('dump')
+        report['users'] = summaries
+        makedirs('dumps')
+        write_report(options.get('report') or 'dumps/run_report.json', report)
+        return
 
     user = pc.get_user(
         username=options['username'],
@@ -265,17 +481,18 @@ def main(options, args):
     if user is None:
         print 'No user found for %s %s' % (options['username'], options['email'])
         exit(1)
-    makedirs('dumps/%s' % user['username'])
-    dump_comments(user, pc.list_comments(user))
-    dump_iterable(user, 'favorite_artists', pc.get_favorite_artists(user))
-    dump_iterable(user, 'favorite_labels', pc.get_favorite_labels(user))
-    dump_iterable(user, 'favorite_stations', pc.get_favorite_stations(user))
+    shared_tracks = open_shared_tracks(options)
+    try:
+        with profiling(pc, options):
+            dump_user(pc, user, archive, shared_tracks)
+    finally:
+        if shared_tracks is not None:
+            shared_tracks.close()
+    logger.info(pc.format_api_stats())
+    write_report(options.get('report') or 'dumps/%s/run_report.json' % user['username'], pc.run_report('dump'))
 
-    user['_playlists'] = set()
-    for playlist in pc.list_playlists(user):
-        dump_playlist(user, playlist)
 
-if __name__ == "__main__":
+def make_parser():
     parser = OptionParser()
     parser.add_option(
       "-u", "--username", dest="username", default=None,
@@ -289,6 +506,28 @@ if __name__ == "__main__":
       "--uid", dest="uid_key", default=None,
       help="dump for UID or key", metavar="UID"
     )
-    (options, args) = parser.parse_args()
+    parser.add_option(
+      "--users", dest="users_file", default=None,
+      help="dump every user listed in FILE, one user key (s1234), email or username per line", metavar="FILE"
+    )
+    parser.add_option(
+      "--report", dest="report", default=None,
+      help="write timings and API call counts for the run to FILE as json (default: in the dump folder)",
+      metavar="FILE"
+    )
+    parser.add_option(
+      "--archive", dest="archive", action="store_true", default=False,
+      help="write playlists to a compressed archive with each track stored once, instead of per-playlist files"
+    )
+    parser.add_option(
+      "--shared-tracks", dest="shared_tracks", action="store_true", default=False,
+      help="with --archive, keep one track table for every user in dumps/"
+    )
+    add_profiling_options(parser)
+    return parser
+
+
+if __name__ == "__main__":
+    (options, args) = make_parser().parse_args()
     options = options.__dict__
     main(options, args)
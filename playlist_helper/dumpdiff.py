@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""Report what changed between two dumps of one user: playlists added and removed, tracks added, removed and moved.
+
+Both dumps can be dump folders (dumps/jmullan) or archive folders
+(dumps/jmullan/archive). Playlists are compared by the hashes the dump
+recorded: one of their track keys, in order, and one of their other fields.
+Only playlists whose tracks hash changed are read, so the time taken follows
+the amount of change rather than the size of the dumps. Playlists where only
+the other fields changed are listed apart. Dumps made before these hashes
+were recorded are read in full and hashed the same way.
+
+    python playlist_helper/dumpdiff.py yesterday/dumps/jmullan today/dumps/jmullan
+"""
+import bisect
+import gzip
+import json
+import os
+import urllib
+from optparse import OptionParser
+
+from archive import MANIFEST, index_name, playlist_digests, read_lines, track_identity
+from dump import PLAYLIST_HASHES, _meta
+
+KEY_META = _meta('t/key')
+PLAYLIST_META = _meta('p/')
+
+
+class DumpFolder(object):
+    """The playlists of a dump folder, by path under playlists/, read from their jspf files.
+
+    `hashes` maps each playlist to its (tracks, fields) digests.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.playlists_folder = os.path.join(folder, 'playlists')
+        self._tracks = {}
+        hashes = {}
+        hashes_filename = os.path.join(folder, PLAYLIST_HASHES)
+        if os.path.exists(hashes_filename):
+            with open(hashes_filename) as infile:
+                hashes = json.load(infile)
+        # dumps from before the tracks were hashed apart from the fields recorded one hash per file
+        if hashes and all(isinstance(digests, dict) for digests in hashes.values()):
+            self.hashes = dict((name, (digests['tracks'], digests['meta'])) for name, digests in hashes.items())
+        else:
+            self.hashes = self._read_all()
+
+    def _read_all(self):
+        hashes = {}
+        for root, _, filenames in os.walk(self.playlists_folder):
+            for filename in filenames:
+                if filename.endswith('.jspf'):
+                    name = os.path.relpath(os.path.join(root, filename), self.playlists_folder)
+                    fields, tracks = self._read(name)
+                    self._tracks[name] = tracks
+                    hashes[name] = playlist_digests(fields, [key for key, _ in tracks])
+        return hashes
+
+    def _read(self, name):
+        with open(os.path.join(self.playlists_folder, name)) as infile:
+            playlist = json.load(infile)['playlist']
+        fields = [
+          (urllib.unquote(url[len(PLAYLIST_META):]), value)
+          for meta in playlist.get('meta', []) for url, value in meta.items()
+        ]
+        return fields, [jspf_track(track) for track in playlist['track']]
+
+    def tracks(self, names):
+        """{name: [(track key, description)]} for some of the playlists."""
+        found = {}
+        for name in names:
+            if name not in self._tracks:
+                self._tracks[name] = self._read(name)[1]
+            found[name] = self._tracks[name]
+        return found
+
+
+def jspf_track(track):
+    key = None
+    for meta in track.get('meta', []):
+        if KEY_META in meta:
+            key = meta[KEY_META]
+    description = u'%s - %s' % (track.get('creator'), track.get('title'))
+    return key or description, description
+
+
+def archive_tracks(track_ids):
+    # a track id is its key, or its key and a hash when the record changed
+    return [(track_identity(track_id), track_id) for track_id in track_ids]
+
+
+class ArchiveFolder(object):
+    """The playlists of an archive folder, by "<playlist_type>/<key or name>", read from its playlists file.
+
+    `hashes` maps each playlist to its (tracks, fields) digests.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        with open(os.path.join(folder, MANIFEST)) as infile:
+            self.manifest = json.load(infile)
+        self.playlists_filename = os.path.join(folder, self.manifest['playlists'])
+        self._tracks = {}
+        self._lines = {}
+        index = self.manifest.get('index')
+        # archives from before the tracks were hashed apart from the fields have no index, or one hash per line
+        if index and all(len(entry) == 3 for entry in index.values()):
+            self.hashes = {}
+            for name, (number, tracks_digest, meta_digest) in index.items():
+                self._lines[name] = number
+                self.hashes[name] = (tracks_digest, meta_digest)
+        else:
+            self.hashes = self._read_all()
+
+    def _read_all(self):
+        hashes = {}
+        for line in read_lines(self.playlists_filename):
+            name = index_name(dict(line['playlist']))
+            self._tracks[name] = archive_tracks(line['tracks'])
+            hashes[name] = playlist_digests(line['playlist'], [key for key, _ in self._tracks[name]])
+        return hashes
+
+    def tracks(self, names):
+        found = dict((name, self._tracks[name]) for name in names if name in self._tracks)
+        lines = dict((self._lines[name], name) for name in names if name not in found)
+        if not lines:
+            return found
+        last = max(lines)
+        with gzip.open(self.playlists_filename, 'rb') as infile:
+            for number, line in enumerate(infile):
+                if number in lines:
+                    found[lines[number]] = archive_tracks(json.loads(line)['tracks'])
+                if number >= last:
+                    break
+        return found
+
+
+def open_dump(folder):
+    if os.path.exists(os.path.join(folder, MANIFEST)):
+        return ArchiveFolder(folder)
+    return DumpFolder(folder)
+
+
+def moved_tracks(old_keys, new_keys):
+    """How many tracks in both lists are out of their old order, relative to the most tracks that kept it."""
+    unused = {}
+    for position, key in enumerate(old_keys):
+        unused.setdefault(key, []).append(position)
+    for positions in unused.values():
+        positions.reverse()
+    old_positions = []
+    for key in new_keys:
+        positions = unused.get(key)
+        if positions:
+            old_positions.append(positions.pop())
+    # the longest increasing run of old positions is the biggest set of tracks that stayed in order
+    tails = []
+    for position in old_positions:
+        index = bisect.bisect_left(tails, position)
+        if index == len(tails):
+            tails.append(position)
+        else:
+            tails[index] = position
+    return len(old_positions) - len(tails)
+
+
+def counted(tracks):
+    counts = {}
+    for key, description in tracks:
+        counts.setdefault(key, [0, description])[0] += 1
+    return counts
+
+
+def playlist_changes(old_tracks, new_tracks):
+    """The tracks added to and removed from a playlist, and how many moved."""
+    old_counts = counted(old_tracks)
+    new_counts = counted(new_tracks)
+    added = []
+    removed = []
+    for key, (count, description) in new_counts.items():
+        added.extend([description] * (count - old_counts.get(key, [0])[0]))
+    for key, (count, description) in old_counts.items():
+        removed.extend([description] * (count - new_counts.get(key, [0])[0]))
+    return {
+      'added': sorted(added),
+      'removed': sorted(removed),
+      'moved': moved_tracks([key for key, _ in old_tracks], [key for key, _ in new_tracks]),
+    }
+
+
+def diff_dumps(old, new):
+    """Compare two opened dumps, reading only the playlists whose tracks hashes differ."""
+    if type(old) is not type(new):
+        raise ValueError('Can only compare two dump folders or two archive folders')
+    added = sorted(set(new.hashes) - set(old.hashes))
+    removed = sorted(set(old.hashes) - set(new.hashes))
+    common = set(old.hashes) & set(new.hashes)
+    changed = sorted(name for name in common if old.hashes[name][0] != new.hashes[name][0])
+    # same tracks in the same order, but a new name, description or other field
+    details = sorted(name for name in common if old.hashes[name] != new.hashes[name] and name not in changed)
+    old_tracks = old.tracks(changed)
+    new_tracks = new.tracks(changed)
+    return {
+      'added': added,
+      'removed': removed,
+      'unchanged': len(common) - len(changed) - len(details),
+      'changed': dict((name, playlist_changes(old_tracks[name], new_tracks[name])) for name in changed),
+      'details_changed': details,
+    }
+
+
+def format_diff(diff, verbose=False):
+    lines = []
+    for name in diff['added']:
+        lines.append(u'+ %s' % name)
+    for name in diff['removed']:
+        lines.append(u'- %s' % name)
+    for name, changes in sorted(diff['changed'].items()):
+        lines.append(u'~ %s: %d added, %d removed, %d moved' % (
+          name, len(changes['added']), len(changes['removed']), changes['moved']))
+        if verbose:
+            lines.extend(u'    + %s' % track for track in changes['added'])
+            lines.extend(u'    - %s' % track for track in changes['removed'])
+    for name in diff['details_changed']:
+        lines.append(u'* %s: details only' % name)
+    lines.append(u'%d playlists added, %d removed, %d changed, %d with new details only, %d unchanged' % (
+      len(diff['added']), len(diff['removed']), len(diff['changed']), len(diff['details_changed']),
+      diff['unchanged']))
+    return u'\n'.join(lines)
+
+
+def main(options, args):
+    if len(args) != 2:
+        raise SystemExit('usage: dumpdiff.py OLD_FOLDER NEW_FOLDER')
+    diff = diff_dumps(open_dump(args[0]), open_dump(args[1]))
+    print format_diff(diff, options['verbose']).encode('utf-8')
+    if options['json']:
+        with open(options['json'], 'w') as outfile:
+            json.dump(diff, outfile, indent=2)
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage='%prog [options] OLD_FOLDER NEW_FOLDER')
+    parser.add_option(
+      "-v", "--verbose", dest="verbose", action="store_true", default=False,
+      help="list the tracks added to and removed from each changed playlist"
+    )
+    parser.add_option(
+      "--json", dest="json", default=None,
+      help="also write the differences to FILE as json", metavar="FILE"
+    )
+    (options, args) = parser.parse_args()
+    options = options.__dict__
+    main(options, args)
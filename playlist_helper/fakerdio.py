@@ -0,0 +1,331 @@
+"""An in-process stand-in for the Rdio API over a synthetic catalog, for benchmarks."""
+
+import json
+import random
+import re
+import threading
+import time
+
+WORDS = [
+  'black', 'blue', 'broken', 'city', 'dance', 'dark', 'dream', 'electric', 'fire', 'ghost',
+  'gold', 'heart', 'highway', 'honey', 'light', 'love', 'midnight', 'moon', 'night', 'ocean',
+  'paper', 'rain', 'river', 'rose', 'silver', 'sky', 'soul', 'star', 'summer', 'sun',
+  'thunder', 'velvet', 'water', 'wild', 'wind', 'winter', 'young', u'caf\xe9', u'ni\xf1o', u'k\xf6ln',
+]
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokens(text):
+    return set(TOKEN_RE.findall(text.lower()))
+
+
+def selected(item, extras):
+    """Apply a nested field selection like [{"field":"*","exclude":true},{"field":"key"}] to one item."""
+    fields = [field for field in extras or [] if isinstance(field, dict)]
+    if not any(field['field'] == '*' and field.get('exclude') for field in fields):
+        return item
+    return dict((field['field'], item[field['field']]) for field in fields if field['field'] in item)
+
+
+def page(items, start, count, page_limit):
+    start = int(start or 0)
+    count = int(count or len(items))
+    if page_limit:
+        count = min(count, page_limit)
+    return items[start:start + count]
+
+
+class FakeRdio(object):
+    """Serve search, get, playlist, favorites and write calls from a generated catalog.
+
+    `tracks` sets the catalog size; `latency` seconds are slept on every call and
+    `page_limit` caps how many items one paged call returns. Calls per method are
+    counted in `calls`.
+    """
+
+    authenticated = True
+
+    def __init__(self, tracks=1000, tracks_per_album=10, albums_per_artist=3, playlists=20,
+                 playlist_length=50, favorites=200, comments=20, latency=0.0, page_limit=None, seed=1):
+        self.latency = latency
+        self.page_limit = page_limit
+        self.calls = {}
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self.objects = {}
+        self._index = {'Artist': {}, 'Album': {}, 'Track': {}}
+        self._next_key = 1
+        # a counter stands in for the lastUpdated timestamps, so runs stay repeatable
+        self._updates = 0
+
+        self.user = self._add('s', {
+          'username': 'bench',
+          'firstName': 'Bench',
+          'lastName': 'Mark',
+          'url': '/people/bench/',
+          'comments': [],
+        })
+        self._playlists = {'owned': [], 'collab': [], 'favorites': [], 'subscribed': []}
+        self._favorites = []
+        self._synced = []
+        self._collections = {}
+        self._build_catalog(tracks, tracks_per_album, albums_per_artist)
+        self._build_user(playlists, playlist_length, favorites, comments)
+
+    def _touch(self, playlist):
+        self._updates += 1
+        playlist['lastUpdated'] = float(self._updates)
+
+    def _add(self, prefix, obj):
+        key = '%s%d' % (prefix, self._next_key)
+        self._next_key += 1
+        obj['key'] = key
+        obj['type'] = prefix
+        self.objects[key] = obj
+        return obj
+
+    def _index_add(self, kind, text, key):
+        index = self._index[kind]
+        for token in tokens(text):
+            index.setdefault(token, []).append(key)
+
+    def _name(self, words):
+        return u' '.join(self._random.choice(WORDS).capitalize() for _ in range(words))
+
+    def _build_catalog(self, tracks, tracks_per_album, albums_per_artist):
+        self.tracks = []
+        self.albums = []
+        self.artists = []
+        while len(self.tracks) < tracks:
+            artist_name = self._name(2)
+            if self._random.random() < 0.2:
+                artist_name = u'The %s' % artist_name
+            artist = self._add('r', {'name': artist_name, 'albumKeys': []})
+            self.artists.append(artist)
+            self._index_add('Artist', artist_name, artist['key'])
+            for _ in range(albums_per_artist):
+                album_name = self._name(self._random.randint(1, 3))
+                album = self._add('a', {'name': album_name, 'artist': artist_name, 'artistKey': artist['key'], 'trackKeys': []})
+                artist['albumKeys'].append(album['key'])
+                self.albums.append(album)
+                self._index_add('Album', u'%s %s' % (artist_name, album_name), album['key'])
+                for track_num in range(1, tracks_per_album + 1):
+                    name = self._name(self._random.randint(1, 4))
+                    if self._random.random() < 0.1:
+                        name = u'%s (Remastered)' % name
+                    track = self._add('t', {
+                      'name': name,
+                      'artist': artist_name,
+                      'album': album_name,
+                      'albumKey': album['key'],
+                      'artistKey': artist['key'],
+                      'trackNum': track_num,
+                      'duration': self._random.randint(90, 420),
+                      'isrcs': ['US%010d' % self._next_key],
+                      'url': '/artist/%s/album/%s/track/%d/' % (artist['key'], album['key'], track_num),
+                    })
+                    album['trackKeys'].append(track['key'])
+                    self.tracks.append(track)
+                    self._index_add('Track', u'%s %s %s' % (artist_name, album_name, name), track['key'])
+
+    def _build_user(self, playlists, playlist_length, favorites, comments):
+        track_keys = [track['key'] for track in self.tracks]
+        kinds = ['owned', 'owned', 'collab', 'favorites']
+        for i in range(playlists):
+            name = self._name(2)
+            playlist = self._add('p', {
+              'name': name,
+              'description': 'Benchmark playlist %d' % i,
+              'owner': 'Bench Mark',
+              'ownerKey': self.user['key'],
+              'trackKeys': self._random.sample(track_keys, min(playlist_length, len(track_keys))),
+            })
+            self._touch(playlist)
+            playlist['url'] = '/people/bench/playlists/%s/%s/' % (playlist['key'][1:], name.replace(' ', '_'))
+            self._playlists[kinds[i % len(kinds)]].append(playlist)
+
+        for track_key in self._random.sample(track_keys, min(favorites, len(track_keys))):
+            self._favorites.append(track_key)
+        self._synced = self._favorites[:len(self._favorites) // 2]
+        for kind in ['artists', 'labels', 'stations']:
+            self._collections[kind] = [{'name': self._name(2)} for _ in range(favorites // 10)]
+
+        for i in range(comments):
+            item = self._random.choice(self.tracks)
+            comment = self._add('c', {
+              'comment': 'Comment number %d' % i,
+              'commentedItem': {'type': 't', 'name': item['name'], 'artist': item['artist']},
+              'datePosted': '2015-11-%02d' % (i % 28 + 1),
+              'likes': [{'username': 'fan%d' % j} for j in range(i % 3)],
+              'comments': [
+                {'commenter': {'username': 'friend%d' % j}, 'comment': 'Reply %d' % j} for j in range(i % 4)
+              ],
+            })
+            self.user['comments'].append(comment['key'])
+
+    def _called(self, method):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def call_count(self):
+        return sum(self.calls.values())
+
+    def _public(self, obj):
+        return dict((k, v) for k, v in obj.items() if k not in ('trackKeys', 'comments', 'albumKeys'))
+
+    def _track(self, key):
+        return dict(self.objects[key])
+
+    # authentication
+
+    def logout(self):
+        pass
+
+    def currentUser(self, extras=None):
+        self._called('currentUser')
+        return self._public(self.user)
+
+    def findUser(self, email=None, vanityName=None, extras=None):
+        self._called('findUser')
+        if vanityName == self.user['username'] or email == 'bench@example.com':
+            return self._public(self.user)
+        return None
+
+    # reads
+
+    def search(self, query, types, never_or=True, extras=None, start=0, count=10):
+        self._called('search')
+        kind = types
+        query_tokens = tokens(query.decode('utf-8') if isinstance(query, str) else query)
+        index = self._index[kind]
+        keys = None
+        for token in query_tokens:
+            matches = index.get(token, [])
+            keys = set(matches) if keys is None else keys & set(matches)
+            if not keys:
+                break
+        keys = sorted(keys or [])
+        results = []
+        for key in page(keys, start, count, self.page_limit):
+            obj = self.objects[key]
+            if kind == 'Artist':
+                result = self._public(obj)
+                if extras and 'albumKeys' in extras:
+                    result['albumKeys'] = list(obj['albumKeys'])
+            elif kind == 'Album':
+                result = dict(obj)
+            else:
+                result = self._track(key)
+            results.append(result)
+        return {'%s_count' % kind.lower(): len(keys), 'results': results}
+
+    def get(self, keys, extras=None):
+        self._called('get')
+        fields = {}
+        if extras and extras.startswith('['):
+            for field in json.loads(extras):
+                fields[field['field']] = field
+        result = {}
+        for key in keys.split(','):
+            obj = self.objects.get(key)
+            if obj is None:
+                continue
+            if obj['type'] == 'p':
+                playlist = self._public(obj)
+                playlist['length'] = len(obj['trackKeys'])
+                if 'tracks' in fields:
+                    track_keys = page(obj['trackKeys'], fields['tracks'].get('start'), fields['tracks'].get('count'), self.page_limit)
+                    playlist['tracks'] = [
+                      selected(self._track(track_key), fields['tracks'].get('extras')) for track_key in track_keys
+                    ]
+                elif extras and 'tracks' in extras.split(','):
+                    playlist['tracks'] = [self._track(track_key) for track_key in obj['trackKeys']]
+                result[key] = playlist
+            elif obj['type'] in ('s', 'c'):
+                item = self._public(obj)
+                if 'comments' in fields:
+                    comment_keys = obj['comments']
+                    if obj['type'] == 's':
+                        comments = page(comment_keys, fields['comments'].get('start'), fields['comments'].get('count'), self.page_limit)
+                        item['comments'] = [self._public(self.objects[comment_key]) for comment_key in comments]
+                    else:
+                        item['comments'] = page(comment_keys, fields['comments'].get('start'), fields['comments'].get('count'), self.page_limit)
+                result[key] = item
+            else:
+                result[key] = dict(obj)
+        return result
+
+    def getPlaylists(self, user=None, extras=None):
+        self._called('getPlaylists')
+        return dict(
+          (kind, [dict(self._public(playlist), length=len(playlist['trackKeys'])) for playlist in playlists])
+          for kind, playlists in self._playlists.items()
+        )
+
+    def _collection(self, track_keys, types, start, count):
+        if types == 'tracksAndAlbums':
+            return [self._track(track_key) for track_key in page(track_keys, start, count, self.page_limit)]
+        return page(self._collections[types], start, count, self.page_limit)
+
+    def getFavorites(self, types, start=0, count=10, user=None, extras=None):
+        self._called('getFavorites')
+        return self._collection(self._favorites, types, start, count)
+
+    def getSynced(self, types, start=0, count=10, user=None, extras=None):
+        self._called('getSynced')
+        return self._collection(self._synced, types, start, count)
+
+    # writes
+
+    def createPlaylist(self, name, description, tracks, extras=None):
+        self._called('createPlaylist')
+        playlist = self._add('p', {
+          'name': name.decode('utf-8'),
+          'description': description.decode('utf-8'),
+          'owner': 'Bench Mark',
+          'ownerKey': self.user['key'],
+          'trackKeys': tracks.split(','),
+        })
+        playlist['url'] = '/people/bench/playlists/%s/created/' % playlist['key'][1:]
+        with self._lock:
+            self._touch(playlist)
+            self._playlists['owned'].append(playlist)
+        return dict(self._public(playlist), length=len(playlist['trackKeys']))
+
+    def addToPlaylist(self, playlist, tracks, extras=None):
+        self._called('addToPlaylist')
+        with self._lock:
+            self.objects[playlist]['trackKeys'].extend(tracks.split(','))
+            self._touch(self.objects[playlist])
+        return True
+
+    def removeFromPlaylist(self, playlist, index, count, tracks, extras=None):
+        self._called('removeFromPlaylist')
+        remove = set(tracks.split(','))
+        with self._lock:
+            obj = self.objects[playlist]
+            index = int(index)
+            window = obj['trackKeys'][index:index + int(count)]
+            obj['trackKeys'][index:index + int(count)] = [key for key in window if key not in remove]
+            self._touch(obj)
+        return True
+
+    def sample_input(self, rows, messy=True):
+        """Build make_playlist input rows for tracks in the catalog, some of them messy."""
+        picked = self._random.sample(self.tracks, min(rows, len(self.tracks)))
+        result = []
+        for track in picked:
+            artist, album, name = track['artist'], track['album'], track['name']
+            if messy:
+                roll = self._random.random()
+                if roll < 0.1 and artist.startswith('The '):
+                    artist = u'%s, The' % artist[4:]
+                elif roll < 0.2:
+                    name = u'%s (Live)' % name
+                elif roll < 0.3:
+                    artist = u'%s feat. %s' % (artist, self._name(1))
+            result.append((artist, album, name))
+        return result
@@ -3,6 +3,7 @@ import logging
 import sys
 from optparse import OptionParser
 
+from metrics import write_report
 from playlistcreator import PlaylistCreator
 
 logging.basicConfig()
@@ -16,25 +17,43 @@ def process_txt(pc, options, track_ids):
     if playlist_description is None:
         playlist_description = 'Songs about %s' % playlist_name
 
-    track_keys = ['t%s' % track_id for track_id in track_ids]
+    with pc.metrics.phase('parse'):
+        track_keys = ['t%s' % track_id for track_id in track_ids]
 
     pc.make_playlist_from_keys(playlist_name, playlist_description, track_keys)
 
 
-def main(options, args):
+def main(options, args, pc=None):
     logger.debug('Options: %s', options)
-    pc = PlaylistCreator()
-    if not pc.authenticated:
-        logger.error('You need to authenticate by running ./authenticate.py first')
-        sys.exit(0)
+    if pc is None:
+        pc = PlaylistCreator(dry_run=options.get('dry_run'))
+        if not pc.dry_run and not pc.authenticated:
+            logger.error('You need to authenticate by running ./authenticate.py first')
+            sys.exit(0)
 
     process_txt(pc, options, args)
+    if not pc.dry_run:
+        logger.info(pc.format_api_stats())
+    if options['report']:
+        write_report(options['report'], pc.run_report('ids'))
 
 
-if __name__ == "__main__":
+def make_parser():
     parser = OptionParser()
     parser.add_option("-n", "--name", dest="playlist_name", help="A name for your playlist")
     parser.add_option("-d", "--description", dest="description", help="The description for the playlist", default=None)
-    (options, track_ids) = parser.parse_args()
+    parser.add_option(
+      "--dry-run", dest="dry_run", action="store_true", default=False,
+      help="report the API calls an import would make without making them"
+    )
+    parser.add_option(
+      "--report", dest="report", default=None,
+      help="write timings and API call counts for the run to FILE as json", metavar="FILE"
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    (options, track_ids) = make_parser().parse_args()
     options = options.__dict__
     main(options, track_ids)
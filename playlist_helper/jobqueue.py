@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+"""A durable sqlite queue for playlist imports, so a big import can be stopped, resumed and shared.
+
+Each input row of a job is resolved on its own and its result recorded, so a
+worker that dies loses at most the rows it had claimed, and those go back to
+the queue once their lease runs out. Any number of workers, in any number of
+processes, can work on the same queue file. When every row is settled the
+playlist is written with make_playlist_from_keys, which syncs against the
+playlist of that name and so is safe to retry.
+
+    python playlist_helper/txt.py --queue import_jobs.db big_playlist.txt
+    python playlist_helper/jobqueue.py list
+    python playlist_helper/jobqueue.py work
+"""
+import hashlib
+import json
+import logging
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from optparse import OptionParser
+
+from metrics import write_report
+from playlistcreator import PlaylistCreator, best_unicode, playlist_mode, split_track
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUEUE = 'import_jobs.db'
+# a row that fails this many times is given up on rather than retried
+MAX_ATTEMPTS = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+  id INTEGER PRIMARY KEY,
+  name TEXT NOT NULL,
+  description TEXT,
+  mode TEXT NOT NULL,
+  fingerprint TEXT NOT NULL,
+  state TEXT NOT NULL DEFAULT 'resolving',
+  claimed_by TEXT,
+  claimed_until REAL,
+  created REAL NOT NULL,
+  updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rows (
+  job_id INTEGER NOT NULL REFERENCES jobs (id),
+  position INTEGER NOT NULL,
+  track TEXT NOT NULL,
+  state TEXT NOT NULL DEFAULT 'pending',
+  keys TEXT,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  error TEXT,
+  claimed_by TEXT,
+  claimed_until REAL,
+  PRIMARY KEY (job_id, position)
+);
+CREATE INDEX IF NOT EXISTS rows_state ON rows (job_id, state);
+"""
+
+ROW_STATES = ['pending', 'claimed', 'found', 'not_found', 'failed']
+
+
+def worker_name():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def fingerprint(name, desc, tracks):
+    """Identify an import by its playlist and input rows, so running it again resumes it."""
+    return hashlib.sha1(json.dumps([name, desc, [list(track) for track in tracks]])).hexdigest()
+
+
+class JobQueue(object):
+    """Import jobs and the resolution state of each of their input rows, in a sqlite file."""
+
+    def __init__(self, path=DEFAULT_QUEUE):
+        self.path = path
+        # autocommit, with explicit transactions where rows are claimed
+        self._db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    @contextmanager
+    def _transaction(self):
+        # IMMEDIATE takes the write lock up front, so two workers never claim the same rows
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            yield self._db
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+
+    def add_job(self, name, desc, tracks):
+        """Queue an import and return its id, or the id of the same import if it is still unfinished."""
+        # sqlite only takes text as unicode; names often come straight from byte string filenames
+        name = best_unicode(name)
+        if desc is not None:
+            desc = best_unicode(desc)
+        tracks = [list(track) for track in tracks]
+        digest = fingerprint(name, desc, tracks)
+        now = time.time()
+        with self._transaction() as db:
+            existing = db.execute(
+              "SELECT id FROM jobs WHERE fingerprint = ? AND state != 'done' ORDER BY id LIMIT 1", (digest,)
+            ).fetchone()
+            if existing is not None:
+                return existing['id']
+            cursor = db.execute(
+              'INSERT INTO jobs (name, description, mode, fingerprint, created, updated) VALUES (?, ?, ?, ?, ?, ?)',
+              (name, desc, playlist_mode(tracks), digest, now, now)
+            )
+            job_id = cursor.lastrowid
+            db.executemany(
+              'INSERT INTO rows (job_id, position, track) VALUES (?, ?, ?)',
+              ((job_id, position, json.dumps(track)) for position, track in enumerate(tracks))
+            )
+        return job_id
+
+    def job(self, job_id):
+        return self._db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+
+    def jobs(self, unfinished=False):
+        query = 'SELECT * FROM jobs'
+        if unfinished:
+            query += " WHERE state != 'done'"
+        return self._db.execute(query + ' ORDER BY id').fetchall()
+
+    def progress(self, job_id):
+        """Count a job's rows in each state."""
+        counts = dict((state, 0) for state in ROW_STATES)
+        for row in self._db.execute('SELECT state, COUNT(*) FROM rows WHERE job_id = ? GROUP BY state', (job_id,)):
+            counts[row[0]] = row[1]
+        return counts
+
+    def claim(self, job_id, worker, count, lease):
+        """Take up to `count` unresolved rows, including ones whose previous worker's lease ran out."""
+        now = time.time()
+        with self._transaction() as db:
+            rows = db.execute(
+              "SELECT position, track FROM rows WHERE job_id = ? "
+              "AND (state = 'pending' OR (state = 'claimed' AND claimed_until < ?)) "
+              "ORDER BY position LIMIT ?",
+              (job_id, now, count)
+            ).fetchall()
+            db.executemany(
+              "UPDATE rows SET state = 'claimed', claimed_by = ?, claimed_until = ? WHERE job_id = ? AND position = ?",
+              ((worker, now + lease, job_id, row['position']) for row in rows)
+            )
+        return [(row['position'], json.loads(row['track'])) for row in rows]
+
+    def resolve(self, job_id, position, keys):
+        self._db.execute(
+          'UPDATE rows SET state = ?, keys = ?, error = NULL, claimed_by = NULL, claimed_until = NULL '
+          'WHERE job_id = ? AND position = ?',
+          ('found' if keys else 'not_found', json.dumps(keys), job_id, position)
+        )
+
+    def fail(self, job_id, position, error):
+        """Put a row back in the queue, unless it has already failed MAX_ATTEMPTS times."""
+        self._db.execute(
+          "UPDATE rows SET attempts = attempts + 1, error = ?, claimed_by = NULL, claimed_until = NULL, "
+          "state = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END "
+          "WHERE job_id = ? AND position = ?",
+          (error, MAX_ATTEMPTS, job_id, position)
+        )
+
+    def track_keys(self, job_id):
+        """The keys found for a job, in input order."""
+        keys = []
+        for row in self._db.execute(
+          "SELECT keys FROM rows WHERE job_id = ? AND state = 'found' ORDER BY position", (job_id,)
+        ):
+            keys.extend(json.loads(row['keys']))
+        return keys
+
+    def claim_write(self, job_id, worker, lease):
+        """Take the playlist write for a job whose rows are all settled; False if it is not ready or taken."""
+        now = time.time()
+        cursor = self._db.execute(
+          "UPDATE jobs SET state = 'writing', claimed_by = ?, claimed_until = ?, updated = ? "
+          "WHERE id = ? AND (state = 'resolving' OR (state = 'writing' AND claimed_until < ?)) "
+          "AND NOT EXISTS (SELECT 1 FROM rows WHERE job_id = ? AND state IN ('pending', 'claimed'))",
+          (worker, now + lease, now, job_id, now, job_id)
+        )
+        return cursor.rowcount == 1
+
+    def renew_write(self, job_id, worker, lease):
+        """Extend a worker's hold on a job's playlist write; False if it no longer holds it."""
+        now = time.time()
+        cursor = self._db.execute(
+          "UPDATE jobs SET claimed_until = ?, updated = ? WHERE id = ? AND state = 'writing' AND claimed_by = ?",
+          (now + lease, now, job_id, worker)
+        )
+        return cursor.rowcount == 1
+
+    def finish(self, job_id, worker):
+        """Mark a job done; False if another worker took its write over in the meantime."""
+        cursor = self._db.execute(
+          "UPDATE jobs SET state = 'done', claimed_by = NULL, claimed_until = NULL, updated = ? "
+          "WHERE id = ? AND state = 'writing' AND claimed_by = ?",
+          (time.time(), job_id, worker)
+        )
+        return cursor.rowcount == 1
+
+
+@contextmanager
+def write_lease(path, job_id, worker, lease):
+    """Keep renewing a job's write lease, on a connection of its own, until the block exits.
+
+    A createPlaylist can outlast the lease, and another worker must not
+    take the write over while this one is still making it.
+    """
+    stopped = threading.Event()
+
+    def renew():
+        queue = JobQueue(path)
+        try:
+            while not stopped.wait(lease / 3):
+                if not queue.renew_write(job_id, worker, lease):
+                    logger.warning('Lost the write lease on job %d', job_id)
+                    return
+        finally:
+            queue.close()
+
+    thread = threading.Thread(target=renew)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def resolve_row(pc, mode, track):
+    """The track keys for one input row, resolved the way make_playlist would."""
+    artistname, albumname, trackname = split_track(track)
+    if mode == 'artists':
+        return pc.find_artist_tracks(artistname)
+    if mode == 'albums':
+        return pc.find_album_tracks(artistname, albumname)
+    track_meta = pc.get_track_meta(track)
+    return [track_meta['key']] if track_meta is not None else []
+
+
+def work(pc, queue, job_id, batch=50, worker=None):
+    """Resolve a job's remaining rows and, once they are all settled, write its playlist.
+
+    Returns True if this worker wrote the playlist.
+    """
+    worker = worker or worker_name()
+    lease = pc.setting('job_lease', 300.0)
+    job = queue.job(job_id)
+    if job is None or job['state'] == 'done':
+        return False
+
+    def attempt(item):
+        position, track = item
+        try:
+            return position, resolve_row(pc, job['mode'], track), None
+        except Exception as ex:
+            logger.warning('Could not resolve row %d of job %d: %s', position, job_id, ex)
+            return position, None, repr(ex)
+
+    while True:
+        claimed = queue.claim(job_id, worker, batch, lease)
+        if not claimed:
+            break
+        # only this thread touches the database; the pool threads only make API calls
+        for position, keys, error in pc.map(attempt, claimed):
+            if error is None:
+                queue.resolve(job_id, position, keys)
+                pc.metrics.incr('queue.resolved')
+            else:
+                queue.fail(job_id, position, error)
+                pc.metrics.incr('queue.failed')
+        progress = queue.progress(job_id)
+        logger.info('Job %d: %d of %d rows settled', job_id,
+                    sum(progress[state] for state in ['found', 'not_found', 'failed']), sum(progress.values()))
+
+    if not queue.claim_write(job_id, worker, lease):
+        job = queue.job(job_id)
+        if job['state'] == 'writing':
+            logger.warning('Job %d is being written by %s; if that worker died, run again after %s',
+                           job_id, job['claimed_by'], time.ctime(job['claimed_until']))
+        elif job['state'] != 'done':
+            logger.info('Job %d still has rows claimed by other workers', job_id)
+        return False
+    with write_lease(queue.path, job_id, worker, lease):
+        pc.make_playlist_from_keys(job['name'], job['description'], queue.track_keys(job_id))
+    if not queue.finish(job_id, worker):
+        logger.warning('Another worker took over writing job %d; check %s for tracks added twice',
+                       job_id, job['name'])
+    return True
+
+
+def run_import(pc, path, name, desc, tracks, batch=50):
+    """Queue an import in the sqlite file at path (or pick up the same one) and work on it."""
+    queue = JobQueue(path)
+    try:
+        job_id = queue.add_job(name, desc, tracks)
+        logger.info('Working on job %d in %s', job_id, path)
+        work(pc, queue, job_id, batch)
+    finally:
+        queue.close()
+
+
+def format_jobs(queue):
+    lines = ['%4s  %-10s %-8s %7s %7s %9s %6s  %s' % (
+      'id', 'state', 'mode', 'pending', 'found', 'not found', 'failed', 'name')]
+    for job in queue.jobs():
+        progress = queue.progress(job['id'])
+        lines.append('%4d  %-10s %-8s %7d %7d %9d %6d  %s' % (
+          job['id'], job['state'], job['mode'], progress['pending'] + progress['claimed'],
+          progress['found'], progress['not_found'], progress['failed'], job['name']))
+    return '\n'.join(lines)
+
+
+def main(options, args, pc=None):
+    command = args[0] if args else 'list'
+    queue = JobQueue(options['queue'])
+    try:
+        if command == 'list':
+            print format_jobs(queue).encode('utf-8')
+            return
+        if command != 'work':
+            logger.error('Unknown command: %s', command)
+            sys.exit(1)
+        if pc is None:
+            pc = PlaylistCreator()
+            if not pc.authenticated:
+                logger.error('You need to authenticate by running `python playlist_helper/authenticate.py` first')
+                sys.exit(1)
+        job_ids = [int(job_id) for job_id in args[1:]] or [job['id'] for job in queue.jobs(unfinished=True)]
+        for job_id in job_ids:
+            work(pc, queue, job_id, options['batch'])
+        logger.info(pc.format_api_stats())
+        if options['report']:
+            write_report(options['report'], pc.run_report('jobqueue'))
+    finally:
+        queue.close()
+
+
+def make_parser():
+    parser = OptionParser(usage='%prog [options] list | work [JOB_ID...]')
+    parser.add_option(
+      "-q", "--queue", dest="queue", default=DEFAULT_QUEUE,
+      help="the sqlite job queue", metavar="FILE"
+    )
+    parser.add_option(
+      "-b", "--batch", dest="batch", type="int", default=50,
+      help="rows to claim at a time", metavar="ROWS"
+    )
+    parser.add_option(
+      "--report", dest="report", default=None,
+      help="write timings and API call counts for the run to FILE as json", metavar="FILE"
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    (options, args) = make_parser().parse_args()
+    options = options.__dict__
+    main(options, args)
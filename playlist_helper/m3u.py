@@ -7,7 +7,9 @@ import subprocess
 import sys
 from optparse import OptionParser
 
+from metrics import write_report
 from playlistcreator import PlaylistCreator
+from profiling import add_options as add_profiling_options, profiling
 
 sample = """
 #CURTRACK 67
@@ -35,7 +37,7 @@ logging.basicConfig()
 logger = logging.getLogger(__name__)
 
 
-def process_m3u(pc, filename):
+def process_m3u(pc, options, filename):
     if not os.path.isfile(filename):
         logger.error('Not a file: %s', filename)
         return
@@ -51,45 +53,72 @@ def process_m3u(pc, filename):
         logger.error('Empty playlist: %s', filename)
 
     tracks = []
-    for line in contents.split('\n'):
-        music_file_path = None
-        track_info = None
-        if line.startswith(codecs.BOM_UTF8):
-            line = line[3:]
-        line = line.strip()
-        if not line.startswith('#'):
-            music_file_path = line
-        if not music_file_path:
-            continue
-        command = ['exiftool', '-json', music_file_path]
-        track_json = subprocess.Popen(command, stdout=subprocess.PIPE).stdout.read()
-        try:
-            track_info = json.loads(track_json)
-        except ValueError:
-            logger.error('Could not load id3 data from %s', music_file_path)
+    with pc.metrics.phase('parse'):
+        for line in contents.split('\n'):
+            music_file_path = None
             track_info = None
-        if not track_info:
-            logger.error('Could not load track info for %s', music_file_path)
-            continue
-        track = [track_info[0]['Artist'], track_info[0]['Title']]
-        tracks.append(track)
-    pc.make_playlist(playlist_name, playlist_description, tracks)
+            if line.startswith(codecs.BOM_UTF8):
+                line = line[3:]
+            line = line.strip()
+            if not line.startswith('#'):
+                music_file_path = line
+            if not music_file_path:
+                continue
+            command = ['exiftool', '-json', music_file_path]
+            track_json = subprocess.Popen(command, stdout=subprocess.PIPE).stdout.read()
+            try:
+                track_info = json.loads(track_json)
+            except ValueError:
+                logger.error('Could not load id3 data from %s', music_file_path)
+                track_info = None
+            if not track_info:
+                logger.error('Could not load track info for %s', music_file_path)
+                continue
+            track = [track_info[0]['Artist'], track_info[0]['Title']]
+            tracks.append(track)
+    if options.get('queue') and not pc.dry_run:
+        from jobqueue import run_import
+        run_import(pc, options['queue'], playlist_name, playlist_description, tracks)
+    else:
+        pc.make_playlist(playlist_name, playlist_description, tracks)
 
 
-def main(options, args):
+def main(options, args, pc=None):
     logger.debug('Options: %s', options)
-    pc = PlaylistCreator()
-    if not pc.authenticated:
-        logger.error('You need to authenticate by running ./authenticate.py first')
-        sys.exit(0)
+    if pc is None:
+        pc = PlaylistCreator(dry_run=options.get('dry_run'))
+        if not pc.dry_run and not pc.authenticated:
+            logger.error('You need to authenticate by running ./authenticate.py first')
+            sys.exit(0)
 
-    for arg in args:
-        process_m3u(pc, arg)
+    with profiling(pc, options):
+        for arg in args:
+            process_m3u(pc, options, arg)
+    if not pc.dry_run:
+        logger.info(pc.format_api_stats())
+    if options['report']:
+        write_report(options['report'], pc.run_report('m3u'))
 
 
-if __name__ == "__main__":
-
+def make_parser():
     parser = OptionParser()
-    (options, args) = parser.parse_args()
+    parser.add_option(
+      "--dry-run", dest="dry_run", action="store_true", default=False,
+      help="report the API calls an import would make without making them"
+    )
+    parser.add_option(
+      "--report", dest="report", default=None,
+      help="write timings and API call counts for the run to FILE as json", metavar="FILE"
+    )
+    parser.add_option(
+      "--queue", dest="queue", default=None,
+      help="record progress in the sqlite job queue FILE so an interrupted import can be resumed", metavar="FILE"
+    )
+    add_profiling_options(parser)
+    return parser
+
+
+if __name__ == "__main__":
+    (options, args) = make_parser().parse_args()
     options = options.__dict__
     main(options, args)
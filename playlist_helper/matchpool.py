@@ -0,0 +1,63 @@
+"""Score search candidates in a pool of processes, so fuzzy matching is not held to one core by the GIL."""
+
+from playlistcreator import Term, fuzz
+
+# candidate strings recur across searches (artists, album names); each process keeps their forms
+_candidate_forms = {}
+_CANDIDATE_FORMS_LIMIT = 100000
+
+
+def fuzz_forms(forms, other_forms):
+    """Term.__eq__ over precomputed forms: whether any pair of forms is within fuzz distance."""
+    return any(fuzz(f, g) for f in forms for g in other_forms)
+
+
+def candidate_forms(candidate):
+    forms = _candidate_forms.get(candidate)
+    if forms is None:
+        if len(_candidate_forms) >= _CANDIDATE_FORMS_LIMIT:
+            _candidate_forms.clear()
+        forms = _candidate_forms[candidate] = list(Term(candidate).forms)
+    return forms
+
+
+def score_unit(unit):
+    """The index of the first candidate whose every field matches the terms, or None.
+
+    A unit is (term forms, start, candidates): the forms of each input term,
+    computed once by the caller, the offset of this chunk, and tuples of
+    candidate strings, one per term.
+    """
+    term_forms, start, candidates = unit
+    for index, candidate in enumerate(candidates):
+        if all(fuzz_forms(forms, candidate_forms(other)) for forms, other in zip(term_forms, candidate)):
+            return start + index
+    return None
+
+
+class MatchPool(object):
+    """Runs score_unit over chunks of candidates in worker processes."""
+
+    def __init__(self, processes, chunk_size=8):
+        from multiprocessing import Pool
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self._pool = Pool(processes)
+
+    def units(self, terms, candidates):
+        term_forms = [list(term.forms) for term in terms]
+        return [
+          (term_forms, start, candidates[start:start + self.chunk_size])
+          for start in range(0, len(candidates), self.chunk_size)
+        ]
+
+    def first_match(self, terms, candidates):
+        """The index of the first candidate tuple matching every Term, or None."""
+        if not candidates:
+            return None
+        indexes = [index for index in self._pool.map(score_unit, self.units(terms, candidates)) if index is not None]
+        return min(indexes) if indexes else None
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
@@ -0,0 +1,58 @@
+"""Counters and phase timers for one run, and the json report built from them."""
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Metrics(object):
+    """Thread-safe counters and per-phase timers.
+
+    Phase time is summed over every thread that was in the phase, so with
+    concurrency above one it can exceed the wall time of the run.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def phase(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - started
+            with self._lock:
+                phase = self.phases.setdefault(name, {'count': 0, 'seconds': 0.0})
+                phase['count'] += 1
+                phase['seconds'] += elapsed
+
+    def hit_rate(self, name):
+        """The share of lookups in a cache that hit, from its `<name>.hits` and `<name>.misses` counters."""
+        hits = self.counters.get('%s.hits' % name, 0)
+        misses = self.counters.get('%s.misses' % name, 0)
+        if not hits + misses:
+            return None
+        return float(hits) / (hits + misses)
+
+    def report(self):
+        with self._lock:
+            return {
+              'started': self.started,
+              'seconds': time.time() - self.started,
+              'counters': dict(self.counters),
+              'phases': dict((name, dict(phase)) for name, phase in self.phases.items()),
+            }
+
+
+def write_report(filename, report):
+    with open(filename, 'w') as outfile:
+        json.dump(report, outfile, indent=2, sort_keys=True)
@@ -1,20 +1,33 @@
 """A Python class for creating and updating playlists based on track and artist names."""
 
-import ConfigParser
 import json
 import logging
 import os.path
 import re
-import shelve
 import sys
+import threading
+import time
+import unicodedata
 
 from levenshtein_distance import levenshtein_distance as distance
-from rdioapi import Rdio
+from metrics import Metrics
+from tracks import Track, compact_tracks
+
+# The API client, the http transport, the shelves, the config parser and the
+# thread pool are imported where they are first used, so that one-shot
+# invocations (and dry runs) only pay for what they touch.
 
 _PATH = os.path.dirname(os.path.realpath(__file__))
 
 LOGGER = logging.getLogger(__name__)
 
+# a bare number could just as well be a username, so only "s" and digits is taken for a user key
+USER_KEY_RE = re.compile(r'^s[0-9]+$')
+USER_BATCH_SIZE = 100
+ALBUM_BATCH_SIZE = 100
+# where a successful authentication check is remembered in oauth_state
+VALIDATED_SESSION_KEY = 'playlist_helper.validated_session'
+
 
 def best_unicode(unknown_string):
     if isinstance(unknown_string, unicode):
@@ -25,14 +38,101 @@ def best_unicode(unknown_string):
 
 
 def uniq(seq):
-    """return non-duplicate items from a sequence, in order"""
+    """return non-duplicate items from a sequence of hashables, in order"""
+    seen = set()
     u = []
     for i in seq:
-        if i not in u:
+        if i not in seen:
+            seen.add(i)
             u.append(i)
     return u
 
 
+def split_track(track):
+    """Unpack an (artist, [album], title) input row into a 3-tuple."""
+    if len(track) == 2:
+        artistname, trackname = track
+        return artistname, None, trackname
+    return tuple(track)
+
+
+def cache_key(track):
+    """The raw found_index shelf key for an (artist, [album], title) input row."""
+    return json.dumps(tuple(track)).encode('utf-8')
+
+
+LEADING_THE_RE = re.compile(r'^the (?=.)')
+
+
+def canonical_form(text):
+    """Fold the differences Term.forms ignores into one string.
+
+    Accents are stripped, parenthesised text and featured artists dropped,
+    '&' spelled 'and', a leading or trailing 'The' removed, and case and
+    whitespace folded.
+    """
+    if text is None:
+        return None
+    original = best_unicode(text)
+    text = unicodedata.normalize('NFKD', original)
+    text = u''.join(c for c in text if not unicodedata.combining(c))
+    text = text.replace(u' & ', u' and ').replace(u'!', u' ')
+    text = Term.PAREN_RE.sub(u'', text)
+    text = Term.FEATURE_RE.sub(u'', text)
+    text = Term.RE_THE.sub(r'\1', text)
+    text = u' '.join(text.lower().replace(u'\xdf', u'ss').split())
+    # names like '!!!' fold to nothing, and must not all share one key
+    return LEADING_THE_RE.sub(u'', text) or u' '.join(original.lower().split())
+
+
+def canonical_key(track):
+    """The found_tracks shelf key shared by every input row that normalizes the same way."""
+    return ('canonical:%s' % json.dumps([canonical_form(part) for part in split_track(track)])).encode('utf-8')
+
+
+def expansion_key(kind, *names):
+    """The expansions shelf key for an artist's album keys or an artist's album, by normalized name."""
+    return ('%s:%s' % (kind, json.dumps([canonical_form(name) for name in names]))).encode('utf-8')
+
+
+def album_tracks_key(album_key):
+    """The expansions shelf key for an album's ordered track keys."""
+    return ('tracks:%s' % album_key).encode('utf-8')
+
+
+def playlist_mode(tracks):
+    """Decide whether make_playlist resolves artists, albums or tracks."""
+    if all((len(track) == 3) and (not track[1]) and (not track[2]) for track in tracks):
+        return 'artists'
+    elif all((len(track) == 3) and (not track[2]) for track in tracks):
+        return 'albums'
+    return 'tracks'
+
+
+def format_plan(plan):
+    """Render a dry-run plan from PlaylistCreator.plan_playlist for people."""
+    lines = [
+      'Dry run for playlist: %s' % plan['name'],
+      '  input rows: %d (%s), %d distinct' % (plan['rows'], plan['mode'], plan['distinct']),
+      '  already resolved: %d' % plan['cached'],
+      '  to resolve: %d' % plan['unresolved'],
+    ]
+    for label in ['tracks', 'searches', 'gets', 'writes', 'calls']:
+        low, high = plan[label]
+        lines.append('  %s: %d - %d' % (label, low, high))
+    low, high = plan['seconds']
+    lines.append('  estimated time: %.1fs - %.1fs at concurrency %d' % (low, high, plan['concurrency']))
+    return '\n'.join(lines)
+
+
+# searches only: strip parens and featured artists together, which no single Term transform does
+QUERY_TRANSFORMS = [('simplified', lambda term: Term.FEATURE_RE.sub('', Term.PAREN_RE.sub('', term)))]
+
+
+def query_string(forms):
+    return u' '.join(u' '.join(forms).split())
+
+
 def fuzz(term, other):
     d = distance(term.lower(), other.lower())
     denominator = float(len(term + other))
@@ -50,20 +150,23 @@ class Term(unicode):
     THE_RE = re.compile(r'^The, (.*)')
     RE_THE = re.compile(r'(.*), The$')
 
+    # (name, transform) pairs; the names let the query planner learn which ones find tracks
+    TRANSFORMS = [
+      ('original', lambda term: u'%s' % term),
+      ('no_parens', lambda term: Term.PAREN_RE.sub('', term)),
+      ('no_featuring', lambda term: Term.FEATURE_RE.sub('', term)),
+      ('no_bangs', lambda term: term.replace('!', ' ')),
+      ('ampersand', lambda term: term.replace(' and ', ' & ')),
+      ('and', lambda term: term.replace(' & ', ' and ')),
+      ('the_last', lambda term: Term.THE_RE.sub(r'\1, The', term)),
+      ('the_first', lambda term: Term.RE_THE.sub(r'The \1', term)),
+      ('no_the_prefix', lambda term: Term.THE_RE.sub(r'\1', term)),
+      ('no_the_suffix', lambda term: Term.RE_THE.sub(r'\1', term)),
+    ]
+
     @property
     def forms(self):
-        return set((
-          '%s' % self,
-          Term.PAREN_RE.sub('', self),
-          Term.FEATURE_RE.sub('', self),
-          self.replace('!', ' '),
-          self.replace(' and ', ' & '),
-          self.replace(' & ', ' and '),
-          re.sub(Term.THE_RE, '\1, The', self),
-          re.sub(Term.RE_THE, 'The \1', self),
-          re.sub(Term.THE_RE, '\1', self),
-          re.sub(Term.RE_THE, '\1', self),
-        ))
+        return set(transform(self) for _, transform in Term.TRANSFORMS)
 
     def __eq__(self, other):
         if not isinstance(other, Term):
@@ -77,27 +180,114 @@ class Term(unicode):
 
 class PlaylistCreator(object):
     _cached_rdio = None
+    _connection_pool = None
+    _match_pool = None
+
+    def __init__(self, dry_run=False, client=None, settings=None):
+        """Open the local caches.
 
-    def __init__(self):
+        `client` stands in for the Rdio API client, e.g. a fakerdio.FakeRdio, and
+        `settings` override the [playlist_helper] values from client.ini.
+        """
+        self.dry_run = dry_run
+        self._client = client
+        self._settings = settings or {}
         self._config = None
         self._client_id = None
         self._client_secret = None
         self._client_callback_uri = None
-        self.oauth_state = shelve.open('oauth_state')
-        self.found_tracks = shelve.open('found_tracks')
+        self._shelves = {}
+        self._shelves_lock = threading.Lock()
+        self._cache_lock = threading.Lock()
+        self._user_lock = threading.Lock()
+        self._current_user = None
+        self._stats_lock = threading.RLock()
+        self._query_stats = None
+        self._query_stats_changed = False
+        self._playlist_keys = {}
+        self.metrics = Metrics()
 
     def __del__(self):
-        self.oauth_state.close()
-        self.found_tracks.close()
+        self.close()
+
+    def close(self):
+        if self._query_stats is not None:
+            self._save_query_stats()
+            # closed shelves would otherwise be reopened by a second close, from __del__
+            self._query_stats = None
+        if self._match_pool is not None:
+            self._match_pool.close()
+            self._match_pool = None
+        with self._shelves_lock:
+            for shelf in self._shelves.values():
+                shelf.close()
+            self._shelves = {}
+
+    def open(self):
+        """Open the local caches now rather than on first use."""
+        self._shelf('oauth_state')
+        self._shelf('found_tracks')
+        self._shelf('found_index')
+        self._shelf('expansions')
+
+    def _shelf(self, name):
+        """Open the named shelf in the working directory the first time it is used.
+
+        A dry run opens it read-only, and one that doesn't exist yet as an
+        empty shelf in memory, so planning leaves the caches as they were.
+        """
+        with self._shelves_lock:
+            if name not in self._shelves:
+                import shelve
+                if self.dry_run:
+                    import anydbm
+                    try:
+                        self._shelves[name] = shelve.open(name, flag='r')
+                    except anydbm.error:
+                        self._shelves[name] = shelve.Shelf({})
+                else:
+                    self._shelves[name] = shelve.open(name)
+            return self._shelves[name]
+
+    @property
+    def oauth_state(self):
+        return self._shelf('oauth_state')
+
+    @property
+    def found_tracks(self):
+        return self._shelf('found_tracks')
+
+    @property
+    def expansions(self):
+        """Artist name to album keys, artist and album name to album key, and album key to track keys."""
+        return self._shelf('expansions')
+
+    @property
+    def found_index(self):
+        """Raw input row keys to the canonical found_tracks keys they resolved under."""
+        return self._shelf('found_index')
 
     @property
     def config(self):
         if self._config is None:
+            import ConfigParser
             self._config = ConfigParser.ConfigParser()
             path = _PATH + '/../client.ini'
             self._config.read([path, os.path.expanduser('~/.rdio-client.ini')])
         return self._config
 
+    def setting(self, name, default):
+        """Read an optional tuning value from the [playlist_helper] section of client.ini."""
+        if name in self._settings:
+            return type(default)(self._settings[name])
+        if self.config.has_option('playlist_helper', name):
+            return type(default)(self.config.get('playlist_helper', name))
+        return default
+
+    @property
+    def concurrency(self):
+        return max(1, self.setting('concurrency', 1))
+
     @property
     def client_id(self):
         if self._client_id is None:
@@ -110,29 +300,118 @@ class PlaylistCreator(object):
             self._client_secret = self.config.get('oauth', 'client_secret')
         return self._client_secret
 
+    @property
+    def connection_pool(self):
+        """Keep-alive connections shared by every thread making API calls."""
+        if self._connection_pool is None:
+            from transport import ConnectionPool
+            self._connection_pool = ConnectionPool(
+              self.setting('pool_size', self.concurrency), timeout=self.setting('timeout', 30.0))
+        return self._connection_pool
+
     @property
     def rdio(self):
         if self._cached_rdio is None:
-            self._cached_rdio = Rdio(
-              self.client_id, self.client_secret, self.oauth_state)
+            from transport import CoalescingClient, RateLimitedClient, TokenBucket, use_connection_pool
+            bucket = TokenBucket(self.setting('rate_limit', 10.0), self.setting('rate_burst', 10))
+            client = self._client
+            if client is None:
+                import rdioapi
+                use_connection_pool(rdioapi, self.connection_pool)
+                client = rdioapi.Rdio(self.client_id, self.client_secret, self.oauth_state)
+            self._cached_rdio = CoalescingClient(RateLimitedClient(
+              client,
+              bucket,
+              retries=self.setting('retries', 4),
+            ))
         return self._cached_rdio
 
     @property
     def authenticated(self):
+        """Whether the stored session works, trusting a check made less than `session_ttl` seconds ago."""
         if not self.rdio.authenticated:
             return False
+        validated = self.oauth_state.get(VALIDATED_SESSION_KEY)
+        if validated and time.time() - validated['at'] < self.setting('session_ttl', 3600.0):
+            self.metrics.incr('session.hits')
+            with self._user_lock:
+                if self._current_user is None:
+                    self._current_user = validated['user']
+            return True
+        self.metrics.incr('session.misses')
         try:
-            return self.rdio.currentUser() is not None
+            current_user = self.current_user()
         except BaseException as ex:
             print ex
+            self.forget_session()
             self.rdio.logout()
             return False
+        if current_user is None:
+            self.forget_session()
+            return False
+        self.oauth_state[VALIDATED_SESSION_KEY] = {'at': time.time(), 'user': current_user}
+        self.oauth_state.sync()
+        return True
+
+    def forget_session(self):
+        with self._user_lock:
+            self._current_user = None
+        if VALIDATED_SESSION_KEY in self.oauth_state:
+            del self.oauth_state[VALIDATED_SESSION_KEY]
+
+    def current_user(self):
+        """The authenticated user, asked for at most once per process."""
+        with self._user_lock:
+            if self._current_user is None:
+                self._current_user = self.rdio.currentUser(extras='vanityName')
+            return self._current_user
+
+    def run_report(self, command):
+        """Everything measured during this run, as a json-ready dict."""
+        report = self.metrics.report()
+        report['command'] = command
+        report['cache'] = {'found_tracks': {
+          'hits': self.metrics.counters.get('found_tracks.hits', 0),
+          'canonical_hits': self.metrics.counters.get('found_tracks.canonical_hits', 0),
+          'misses': self.metrics.counters.get('found_tracks.misses', 0),
+          'hit_rate': self.metrics.hit_rate('found_tracks'),
+        }, 'expansions': {
+          'hits': self.metrics.counters.get('expansions.hits', 0),
+          'stale': self.metrics.counters.get('expansions.stale', 0),
+          'misses': self.metrics.counters.get('expansions.misses', 0),
+          'hit_rate': self.metrics.hit_rate('expansions'),
+        }, 'playlist_keys': {
+          'hits': self.metrics.counters.get('playlist_keys.hits', 0),
+          'misses': self.metrics.counters.get('playlist_keys.misses', 0),
+          'hit_rate': self.metrics.hit_rate('playlist_keys'),
+        }}
+        if self._cached_rdio is not None:
+            report['api'] = dict(
+              (method, histogram.as_dict()) for method, histogram in self.rdio.latencies.items()
+            )
+            report['coalesced'] = dict(self.rdio.coalesced)
+            report['connections'] = self.connection_pool.as_dict()
+        return report
+
+    def reset_stats(self):
+        """Start the run report afresh: phases and counters, API latencies, coalesced calls and connection reuse."""
+        self.metrics = Metrics()
+        if self._cached_rdio is not None:
+            self._cached_rdio.reset_stats()
+        if self._connection_pool is not None:
+            self._connection_pool.reset_stats()
+
+    def format_api_stats(self):
+        """Per-method API latency and connection reuse, for logging at the end of a run."""
+        return 'API latency:\n%s\nCoalesced calls: %s\nConnections: %s' % (
+          self.rdio.format_latencies(), self.rdio.format_coalesced(), self.connection_pool)
 
     def authenticate(self):
         # let's clear our old auth state
         for k in self.oauth_state.keys():
             del self.oauth_state[k]
         self._cached_rdio = None
+        self._current_user = None
 
         # do a PIN based auth
         import webbrowser
@@ -142,84 +421,255 @@ class PlaylistCreator(object):
         self.rdio.complete_authentication()
         print 'Successfully authenticated'
 
-    def find_artist_tracks(self, artist):
-        """try to find a track but apply various transfomations."""
+    @property
+    def query_stats(self):
+        """Searches and successful matches per (search type, transform), as learned so far."""
+        with self._stats_lock:
+            if self._query_stats is None:
+                with self._cache_lock:
+                    self._query_stats = dict(self._shelf('query_stats'))
+            return self._query_stats
+
+    def _save_query_stats(self):
+        with self._stats_lock:
+            # a dry run plans searches without making them, so it learns nothing to save
+            if self._query_stats is not None and self._query_stats_changed:
+                shelf = self._shelf('query_stats')
+                shelf.update(self._query_stats)
+                shelf.sync()
+                self._query_stats_changed = False
+
+    def query_success_rate(self, kind, name):
+        tries, hits = self.query_stats.get('%s:%s' % (kind, name), (0, 0))
+        # smoothed, so untried transforms are neither trusted nor written off
+        return (hits + 1.0) / (tries + 2.0)
+
+    def plan_queries(self, kind, *terms):
+        """The distinct searches to try for some Terms, most likely to find a `kind` result first.
+
+        Every transform is applied to all of the terms at once. Transforms
+        that produce the same query string collapse into one search, and
+        searches are ordered by how often their transforms have found a match
+        before, keeping the transform order for ties. Returns (transform
+        names, forms) pairs.
+        """
+        with self.metrics.phase('normalize'):
+            planned = []
+            by_query = {}
+            for name, transform in Term.TRANSFORMS + QUERY_TRANSFORMS:
+                forms = tuple(transform(term) for term in terms)
+                query = query_string(forms)
+                if not query:
+                    continue
+                if query in by_query:
+                    by_query[query][0].append(name)
+                    continue
+                by_query[query] = ([name], forms)
+                planned.append(by_query[query])
+            rate = lambda names: max(self.query_success_rate(kind, name) for name in names)
+            return sorted(planned, key=lambda plan: -rate(plan[0]))
+
+    def record_query(self, kind, names, matched):
+        """Learn from one planned search whether it found a match."""
+        self.metrics.incr('queries.%s' % ('matched' if matched else 'unmatched'))
+        with self._stats_lock:
+            stats = self.query_stats
+            for name in names:
+                tries, hits = stats.get('%s:%s' % (kind, name), (0, 0))
+                stats['%s:%s' % (kind, name)] = (tries + 1, hits + int(matched))
+            self._query_stats_changed = True
+
+    def cached_expansion(self, key, record=True):
+        """A value from the expansions shelf, or None if it is missing or older than `expansion_ttl` seconds."""
+        with self._cache_lock:
+            entry = self.expansions.get(key)
+        if entry is None:
+            outcome = 'misses'
+        elif time.time() - entry['at'] > self.setting('expansion_ttl', 604800.0):
+            outcome = 'stale'
+        else:
+            outcome = 'hits'
+        if record:
+            self.metrics.incr('expansions.%s' % outcome)
+        return entry['value'] if outcome == 'hits' else None
+
+    def store_expansion(self, key, value):
+        with self._cache_lock:
+            self.expansions[key] = {'at': time.time(), 'value': value}
+
+    def search(self, **kwargs):
+        with self.metrics.phase('search'):
+            return self.rdio.search(**kwargs)
+
+    def match(self, *pairs):
+        """Whether every (Term, candidate string) pair matches fuzzily."""
+        with self.metrics.phase('match'):
+            return all(term == other for term, other in pairs)
+
+    def _start_match_pool(self):
+        """Start the match pool if match_processes asks for one and no other thread runs, and return it.
+
+        Forking alongside running threads would copy locks they hold into the
+        workers, so once threads are running a pool that was not started stays
+        unstarted, and scoring stays in-process.
+        """
+        if self._match_pool is None and threading.active_count() == 1:
+            processes = self.setting('match_processes', 0)
+            if processes > 0:
+                from matchpool import MatchPool
+                self._match_pool = MatchPool(processes, self.setting('match_chunk_size', 8))
+        return self._match_pool
+
+    @property
+    def match_pool(self):
+        """Worker processes for scoring candidates, started the first time they are wanted."""
+        return self._start_match_pool()
+
+    def first_match(self, terms, candidates):
+        """The index of the first candidate tuple whose fields all match `terms`, or None.
+
+        Only pages of at least `match_pool_min_candidates` go to the match
+        pool; smaller ones are scored faster in-process than sent to it.
+        """
+        pool = None
+        if len(candidates) >= self.setting('match_pool_min_candidates', 100):
+            pool = self.match_pool
+        if pool is None:
+            for index, candidate in enumerate(candidates):
+                if self.match(*zip(terms, candidate)):
+                    return index
+            return None
+        with self.metrics.phase('match'):
+            return pool.first_match(terms, candidates)
+
+    def search_artist_album_keys(self, artist):
+        """Search for an artist, applying various transformations, and return its album keys."""
         artist = Term(artist)
         LOGGER.info('Finding tracks for artist %s', artist)
         search_succeeded = False
 
-        # for each of the forms, search...
+        # for each of the planned searches, most promising first...
         album_keys = []
-        for a in uniq(artist.forms):
+        for names, (a,) in self.plan_queries('Artist', artist):
             # query the API
             q = ('%s' % a).encode('utf-8')
-            result = self.rdio.search(query=q, types='Artist', never_or=True, extras="albumKeys")
+            result = self.search(query=q, types='Artist', never_or=True, extras="albumKeys")
 
             # if there were no results then the search failed
             if not result or not result.get('artist_count'):
                 LOGGER.warning('rdio.search failed for: "%s"', q)
+                self.record_query('Artist', names, False)
                 continue
 
             # look through the results for a good match
             search_succeeded = True
-            for artist_result in result['results']:
-                if artist == artist_result['name']:
-                    if not artist_result.get('albumKeys'):
-                        LOGGER.warn('No track keys for album result: %r', artist_result)
-                    album_keys = artist_result.get('albumKeys')
-                    break
-
-        track_keys = []
-        for album_key in album_keys:
-            albums = self.rdio.get(keys=','.join(album_keys))
-            for album in albums.values():
-                album_tracks = album.get('trackKeys', [])
-                track_keys += album_tracks
-        track_keys = uniq(track_keys)
+            index = self.first_match((artist,), [(artist_result['name'],) for artist_result in result['results']])
+            if index is not None:
+                artist_result = result['results'][index]
+                if not artist_result.get('albumKeys'):
+                    LOGGER.warn('No track keys for album result: %r', artist_result)
+                album_keys = artist_result.get('albumKeys')
+            self.record_query('Artist', names, bool(album_keys))
+            if album_keys:
+                break
 
-        if search_succeeded:
-            if not track_keys:
-                LOGGER.warning('rdio.search succeeded but match failed for: %s', artist)
-                LOGGER.warning('No tracks found for artist: %s', artist)
-        else:
+        if not search_succeeded:
             LOGGER.warning('rdio.search completely failed for: %s', artist)
+        elif not album_keys:
+            LOGGER.warning('rdio.search succeeded but match failed for: %s', artist)
+        return album_keys or []
+
+    def artist_album_keys(self, artist):
+        """An artist's album keys, from the expansions cache when it is fresh."""
+        key = expansion_key('artist', artist)
+        album_keys = self.cached_expansion(key)
+        if album_keys is None:
+            album_keys = self.search_artist_album_keys(artist)
+            if album_keys:
+                self.store_expansion(key, album_keys)
+        return album_keys
+
+    def album_track_keys(self, album_keys):
+        """Map album keys to their ordered track keys, getting missing or stale ones in batches."""
+        found = {}
+        missing = []
+        for album_key in uniq(album_keys):
+            track_keys = self.cached_expansion(album_tracks_key(album_key))
+            if track_keys is None:
+                missing.append(album_key)
+            else:
+                found[album_key] = track_keys
+        for start in range(0, len(missing), ALBUM_BATCH_SIZE):
+            batch = missing[start:start + ALBUM_BATCH_SIZE]
+            albums = self.rdio.get(keys=','.join(batch))
+            for album_key in batch:
+                album = albums.get(album_key)
+                found[album_key] = album.get('trackKeys', []) if album else []
+                if album:
+                    self.store_expansion(album_tracks_key(album_key), found[album_key])
+        return found
+
+    def find_artist_tracks(self, artist):
+        """The track keys of every album by an artist."""
+        album_keys = self.artist_album_keys(artist)
+        album_tracks = self.album_track_keys(album_keys)
+        track_keys = uniq([track_key for album_key in album_keys for track_key in album_tracks[album_key]])
+        if album_keys and not track_keys:
+            LOGGER.warning('No tracks found for artist: %s', artist)
         return track_keys
 
     def find_album_tracks(self, artist, album):
-        """try to find a track but apply various transfomations."""
+        """The ordered track keys of an artist's album, from the expansions cache when it is fresh."""
         if album is None or album == '':
             LOGGER.warn('No album given for artist: %s %s', artist, album)
             return []
+        album_key = self.cached_expansion(expansion_key('album', artist, album))
+        if album_key is None:
+            return self.search_album_tracks(artist, album)
+        return self.album_track_keys([album_key])[album_key]
+
+    def search_album_tracks(self, artist, album):
+        """Search for an album, applying various transformations, and return its track keys."""
+        album_result = self.search_album(artist, album)
+        if album_result is None:
+            return []
+        if album_result.get('key'):
+            self.store_expansion(expansion_key('album', artist, album), album_result['key'])
+            self.store_expansion(album_tracks_key(album_result['key']), album_result['trackKeys'])
+        return album_result['trackKeys']
 
+    def search_album(self, artist, album):
+        """try to find an album but apply various transfomations."""
         artist = Term(artist)
         album = Term(album)
 
         LOGGER.info('Finding tracks for artist %s album %s', artist, album)
         search_succeeded = False
 
-        # for each of the forms, search...
-        for a, r in uniq(zip(artist.forms, album.forms)):
+        # for each of the planned searches, most promising first...
+        for names, (a, r) in self.plan_queries('Album', artist, album):
             # query the API
             q = ('%s %s' % (a, r)).encode('utf-8')
-            result = self.rdio.search(query=q, types='Album', never_or=True)
+            result = self.search(query=q, types='Album', never_or=True)
 
             # if there were no results then the search failed
             if not result['album_count']:
                 LOGGER.warning('rdio.search failed for: "%s"', q)
+                self.record_query('Album', names, False)
                 continue
 
             # look through the results for a good match
             search_succeeded = True
-            for album_result in result['results']:
-                if artist == album_result['artist'] and album == album_result['name']:
-                    if not album_result['trackKeys']:
-                        LOGGER.warn('No track keys for album result: %r', album_result)
-                    return album_result['trackKeys']
+            album_result = self.first_album_match(artist, album, result['results'])
+            if album_result is not None:
+                self.record_query('Album', names, True)
+                return album_result
+            self.record_query('Album', names, False)
 
         if album == artist:
-            # query the API
-            q = ('%s' % a).encode('utf-8')
-            result = self.rdio.search(query=q, types='Album', never_or=True)
+            # a self-titled album: search for the artist's name alone
+            q = (u'%s' % artist).encode('utf-8')
+            result = self.search(query=q, types='Album', never_or=True)
 
             # if there were no results then the search failed
             if not result['album_count']:
@@ -227,17 +677,24 @@ class PlaylistCreator(object):
             else:
                 # look through the results for a good match
                 search_succeeded = True
-                for album_result in result['results']:
-                    if artist == album_result['artist'] and album == album_result['name']:
-                        if not album_result['trackKeys']:
-                            LOGGER.warn('No track keys for album result: %r', album_result)
-                        return album_result['trackKeys']
+                album_result = self.first_album_match(artist, album, result['results'])
+                if album_result is not None:
+                    return album_result
         # none found
         if search_succeeded:
             LOGGER.warning('rdio.search succeeded but match failed for: %s %s', artist, album)
         else:
             LOGGER.warning('rdio.search completely failed for: %s %s', artist, album)
-        return []
+        return None
+
+    def first_album_match(self, artist, album, album_results):
+        index = self.first_match((artist, album), [(result['artist'], result['name']) for result in album_results])
+        if index is None:
+            return None
+        album_result = album_results[index]
+        if not album_result['trackKeys']:
+            LOGGER.warn('No track keys for album result: %r', album_result)
+        return album_result
 
     def find_album_track(self, artist, album, title):
         """try to find a track but apply various transfomations."""
@@ -248,23 +705,27 @@ class PlaylistCreator(object):
         album = Term(album)
         title = Term(title)
 
-        # for each of the forms, search...
-        for a, r, t in uniq(zip(artist.forms, album.forms, title.forms)):
+        # for each of the planned searches, most promising first...
+        for names, (a, r, t) in self.plan_queries('AlbumTrack', artist, album, title):
             # query the API
             q = ('%s %s %s' % (a, r, t)).encode('utf-8')
-            result = self.rdio.search(query=q, types='Track', never_or=True)
+            result = self.search(query=q, types='Track', never_or=True)
 
             # if there were no results then the search failed
             if not result['track_count']:
                 LOGGER.warning('rdio.search failed for: "%s"', q)
+                self.record_query('AlbumTrack', names, False)
                 continue
 
             # look through the results for a good match
-            for track in result['results']:
-                if artist == track['artist'] and title == track['name'] and (album is None or album == track['album']):
-                    return track
+            index = self.first_match(
+              (artist, title, album), [(track['artist'], track['name'], track['album']) for track in result['results']])
+            if index is not None:
+                self.record_query('AlbumTrack', names, True)
+                return result['results'][index]
             # none found
             LOGGER.warning('rdio.search succeeded but match failed for "%s"', q)
+            self.record_query('AlbumTrack', names, False)
             return None
 
     def find_track(self, artist, title):
@@ -272,72 +733,296 @@ class PlaylistCreator(object):
         artist = Term(artist)
         title = Term(title)
 
-        # for each of the forms, search...
-        for a, t in uniq(zip(artist.forms, title.forms)):
+        # for each of the planned searches, most promising first...
+        for names, (a, t) in self.plan_queries('Track', artist, title):
             # query the API
             q = ('%s %s' % (a, t)).encode('utf-8')
-            result = self.rdio.search(query=q, types='Track', never_or=True)
+            result = self.search(query=q, types='Track', never_or=True)
 
             # if there were no results then the search failed
             if not result['track_count']:
                 LOGGER.warning('rdio.search failed for: %s', q)
+                self.record_query('Track', names, False)
                 continue
 
             # look through the results for a good match
-            for track in result['results']:
-                if artist == track['artist'] and title == track['name']:
-                    return track
+            index = self.first_match((artist, title), [(track['artist'], track['name']) for track in result['results']])
+            if index is not None:
+                self.record_query('Track', names, True)
+                return result['results'][index]
             # none found
             LOGGER.warning('rdio.search succeeded but match failed: "%s"', q)
+            self.record_query('Track', names, False)
             return None
 
     def get_artists_meta(self, tracks):
+        """Expand artist rows into their tracks, looking each distinct artist up once."""
+        artists = {}
+        for track in tracks:
+            artists.setdefault(canonical_form(track[0]), track[0])
+        names = artists.keys()
+        album_keys = dict(zip(names, self.map(lambda name: self.artist_album_keys(artists[name]), names)))
+        album_tracks = self.album_track_keys([key for keys in album_keys.values() for key in keys])
+
         tracks_meta = []
         for track in tracks:
-            artistname, albumname, _ = track
-            track_meta = self.find_artist_tracks(artistname)
-            for track in track_meta:
-                tracks_meta.append({'key': track})
+            for album_key in album_keys[canonical_form(track[0])]:
+                for track_key in album_tracks[album_key]:
+                    tracks_meta.append({'key': track_key})
         return tracks_meta
 
     def get_albums_meta(self, tracks):
+        """Expand album rows into their tracks, looking each distinct album up once.
+
+        Albums whose key is cached have their track lists refreshed together;
+        the rest are searched for.
+        """
+        albums = {}
+        for track in tracks:
+            albums.setdefault((canonical_form(track[0]), canonical_form(track[1])), track)
+        album_keys = dict(
+          (album, self.cached_expansion(expansion_key('album', row[0], row[1])) if row[1] else None)
+          for album, row in albums.items()
+        )
+        album_tracks = self.album_track_keys([key for key in album_keys.values() if key is not None])
+        track_keys = dict((album, album_tracks[key]) for album, key in album_keys.items() if key is not None)
+        unknown = [album for album, key in album_keys.items() if key is None]
+        track_keys.update(zip(unknown, self.map(lambda album: self.find_album_tracks(*albums[album][:2]), unknown)))
+
         tracks_meta = []
         for track in tracks:
-            artistname, albumname, _ = track
-            track_meta = self.find_album_tracks(artistname, albumname)
-            for track in track_meta:
-                tracks_meta.append({'key': track})
+            for track_key in track_keys[(canonical_form(track[0]), canonical_form(track[1]))]:
+                tracks_meta.append({'key': track_key})
         return tracks_meta
 
+    def map(self, function, items):
+        """Apply function to each item, in order, on up to `concurrency` threads."""
+        items = list(items)
+        workers = min(self.concurrency, len(items))
+        if workers < 2:
+            return [function(item) for item in items]
+        # the threads below may want to score matches, and the match pool can only fork before they start
+        self._start_match_pool()
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(workers)
+        try:
+            return pool.map(function, items, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def cached_track_meta(self, track, remember=True):
+        """Look an input row up in found_tracks, returning (track_meta or None, canonical key).
+
+        The raw row is tried in found_index first, then its canonical key,
+        then the raw key itself, which is where entries from before canonical
+        keys live. With `remember`, a row found any way but the first is
+        indexed (and an old entry copied to its canonical key) so the next
+        lookup is direct.
+        """
+        raw = cache_key(track)
+        with self._cache_lock:
+            canonical = self.found_index.get(raw)
+            if canonical is not None:
+                track_meta = self.found_tracks.get(canonical)
+                if track_meta is not None:
+                    return track_meta, canonical
+            canonical = canonical_key(track)
+            track_meta = self.found_tracks.get(canonical)
+            if track_meta is not None:
+                self.metrics.incr('found_tracks.canonical_hits')
+            else:
+                track_meta = self.found_tracks.get(raw)
+                if track_meta is not None and remember:
+                    self.found_tracks[canonical] = track_meta
+            if track_meta is not None and remember:
+                self.found_index[raw] = canonical
+        return track_meta, canonical
+
+    def get_track_meta(self, track):
+        """Resolve one (artist, [album], title) input row, consulting found_tracks first."""
+        artistname, albumname, trackname = split_track(track)
+        LOGGER.debug('Looking for: %s' % cache_key(track))
+
+        track_meta, key = self.cached_track_meta(track)
+        if track_meta is not None:
+            LOGGER.info('found it in the cache: %s' % track_meta['key'])
+            self.metrics.incr('found_tracks.hits')
+            return track_meta
+
+        self.metrics.incr('found_tracks.misses')
+        if albumname is not None:
+            track_meta = self.find_album_track(artistname, albumname, trackname)
+        if track_meta is None:
+            track_meta = self.find_track(artistname, trackname)
+        if track_meta is not None:
+            LOGGER.info('found it in on the site: %s' % track_meta['key'])
+            self.metrics.incr('tracks.found')
+            # only the fields writers use are cached, not the whole API response
+            track_meta = Track.from_api(track_meta, extras=False)
+            with self._cache_lock:
+                self.found_tracks[key] = track_meta
+                self.found_index[cache_key(track)] = key
+        else:
+            LOGGER.info('not found')
+            self.metrics.incr('tracks.not_found')
+        return track_meta
+
     def get_tracks_meta(self, tracks):
-        tracks_meta = []
-        for track in tracks:
-            if len(track) == 2:
-                albumname = None
-                artistname, trackname = track
-                key = json.dumps((artistname, trackname)).encode('utf-8')
-                LOGGER.debug('Looking for: %s' % key)
-            elif len(track) == 3:
-                artistname, albumname, trackname = track
-                key = json.dumps((artistname, albumname, trackname)).encode('utf-8')
-
-            if key in self.found_tracks:
-                LOGGER.info('found it in the cache: %s' % self.found_tracks[key]['key'])
-                tracks_meta.append(self.found_tracks[key])
+        return [track_meta for track_meta in self.map(self.get_track_meta, tracks) if track_meta is not None]
+
+    def _plan(self, name, mode, rows):
+        return {
+          'name': name,
+          'mode': mode,
+          'rows': rows,
+          'distinct': rows,
+          'cached': 0,
+          'unresolved': 0,
+          'tracks': [0, 0],
+          'searches': [0, 0],
+          'gets': [0, 0],
+          'writes': [0, 0],
+          'calls': [0, 0],
+          'seconds': [0.0, 0.0],
+          'concurrency': self.concurrency,
+        }
+
+    def _plan_writes(self, plan):
+        """Add the playlist sync calls and the time estimate to a plan.
+
+        Syncing always lists the owned playlists; a new playlist is a
+        createPlaylist plus an add per further chunk of tracks, an existing
+        one is a get plus a remove and an add per chunk.
+        """
+        chunk_size = max(1, self.setting('write_chunk_size', 500))
+        chunks = [max(1, (tracks + chunk_size - 1) // chunk_size) for tracks in plan['tracks']]
+        plan['gets'][0] += 1
+        plan['gets'][1] += 2
+        plan['writes'][0] += chunks[0]
+        plan['writes'][1] += 2 * chunks[1]
+        latency = self.setting('request_latency', 0.5)
+        for i in [0, 1]:
+            searches = plan['searches'][i]
+            serial = plan['gets'][i] + plan['writes'][i]
+            plan['calls'][i] = searches + serial
+            batches = (searches + plan['concurrency'] - 1) // plan['concurrency']
+            plan['seconds'][i] = (batches + serial) * latency
+        return plan
+
+    def _plan_album_tracks(self, plan, album_keys, uncached):
+        """Add the album track list gets and the tracks they expand to.
+
+        `album_keys` are known; `uncached` is the fewest and the most albums
+        whose track lists are not cached besides those. Missing lists are got
+        ALBUM_BATCH_SIZE at a time across the whole playlist, as album_track_keys does.
+        """
+        track_keys = []
+        missing = 0
+        for album_key in uniq(album_keys):
+            cached = self.cached_expansion(album_tracks_key(album_key), record=False)
+            if cached is None:
+                missing += 1
             else:
-                track_meta = None
-                if albumname is not None:
-                    track_meta = self.find_album_track(artistname, albumname, trackname)
-                if track_meta is None:
-                    track_meta = self.find_track(artistname, trackname)
-                if track_meta is not None:
-                    LOGGER.info('found it in on the site: %s' % track_meta['key'])
-                    tracks_meta.append(track_meta)
-                    self.found_tracks[key] = track_meta
-                else:
-                    LOGGER.info('not found')
-                    pass
-        return tracks_meta
+                track_keys.extend(cached)
+        album_tracks = [1, self.setting('plan_album_tracks', 20)]
+        for i in [0, 1]:
+            albums = missing + uncached[i]
+            plan['gets'][i] += (albums + ALBUM_BATCH_SIZE - 1) // ALBUM_BATCH_SIZE
+            plan['tracks'][i] += len(uniq(track_keys)) + albums * album_tracks[i]
+
+    def plan_playlist(self, name, tracks):
+        """Estimate what make_playlist would cost without touching the network or writing the caches.
+
+        Rows are counted once per canonical form, as make_playlist resolves
+        them. Rows that would need resolving are counted as one search at
+        best and as every query form at worst. Where the caches can't say how
+        many albums an artist has or how many tracks an album has, the best
+        case assumes one, the worst `plan_artist_albums` and `plan_album_tracks`.
+        """
+        mode = playlist_mode(tracks)
+        plan = self._plan(name, mode, len(tracks))
+        if mode == 'artists':
+            self._plan_artists(plan, tracks)
+        elif mode == 'albums':
+            self._plan_albums(plan, tracks)
+        else:
+            self._plan_tracks(plan, tracks)
+        return self._plan_writes(plan)
+
+    def _plan_artists(self, plan, tracks):
+        artists = {}
+        for track in tracks:
+            artists.setdefault(canonical_form(track[0]), track[0])
+        plan['distinct'] = len(artists)
+        album_keys = []
+        searched = 0
+        for artistname in artists.values():
+            cached = self.cached_expansion(expansion_key('artist', artistname), record=False)
+            if cached is not None:
+                plan['cached'] += 1
+                album_keys.extend(cached)
+                continue
+            plan['unresolved'] += 1
+            plan['searches'][0] += 1
+            plan['searches'][1] += len(self.plan_queries('Artist', Term(artistname)))
+            searched += 1
+        # a searched artist's albums are only known after the search, and none of their track lists are cached
+        self._plan_album_tracks(plan, album_keys, [searched, searched * self.setting('plan_artist_albums', 10)])
+
+    def _plan_albums(self, plan, tracks):
+        albums = {}
+        for track in tracks:
+            albums.setdefault((canonical_form(track[0]), canonical_form(track[1])), track)
+        plan['distinct'] = len(albums)
+        album_keys = []
+        searched = 0
+        for row in albums.values():
+            artistname, albumname = row[0], row[1]
+            if not albumname:
+                continue
+            album_key = self.cached_expansion(expansion_key('album', artistname, albumname), record=False)
+            if album_key is not None:
+                plan['cached'] += 1
+                album_keys.append(album_key)
+                continue
+            plan['unresolved'] += 1
+            queries = len(self.plan_queries('Album', Term(artistname), Term(albumname)))
+            if Term(albumname) == artistname:
+                queries += 1
+            plan['searches'][0] += 1
+            plan['searches'][1] += queries
+            searched += 1
+        self._plan_album_tracks(plan, album_keys, [0, 0])
+        # a searched album comes with its track keys, so it needs no get
+        plan['tracks'][0] += searched
+        plan['tracks'][1] += searched * self.setting('plan_album_tracks', 20)
+
+    def _plan_tracks(self, plan, tracks):
+        rows = {}
+        for track in tracks:
+            rows.setdefault(canonical_key(track), []).append(track)
+        plan['distinct'] = len(rows)
+        plan['tracks'] = [len(rows), len(rows)]
+        for same in rows.values():
+            if self.cached_track_meta(same[0], remember=False)[0] is not None:
+                plan['cached'] += 1
+                continue
+            artistname, albumname, trackname = split_track(same[0])
+            plan['unresolved'] += 1
+            queries = len(self.plan_queries('Track', Term(artistname), Term(trackname)))
+            if albumname:
+                queries += len(self.plan_queries('AlbumTrack', Term(artistname), Term(albumname), Term(trackname)))
+            plan['searches'][0] += 1
+            # rows resolved at the same time can each search before either is cached
+            plan['searches'][1] += queries * len(same)
+
+    def plan_playlist_from_keys(self, name, track_keys):
+        """Estimate what make_playlist_from_keys would cost without touching the network."""
+        plan = self._plan(name, 'keys', len(track_keys))
+        plan['cached'] = len(track_keys)
+        plan['tracks'] = [len(track_keys), len(track_keys)]
+        return self._plan_writes(plan)
 
     def make_playlist(self, name, desc, tracks):
         """Make or update a playlist.
@@ -349,9 +1034,15 @@ class PlaylistCreator(object):
             LOGGER.warn('No tracks for playlist')
             return
 
-        if all((len(track) == 3) and (not track[1]) and (not track[2]) for track in tracks):
+        if self.dry_run:
+            plan = self.plan_playlist(name, tracks)
+            print format_plan(plan)
+            return plan
+
+        mode = playlist_mode(tracks)
+        if mode == 'artists':
             tracks_meta = self.get_artists_meta(tracks)
-        elif all((len(track) == 3) and (not track[2]) for track in tracks):
+        elif mode == 'albums':
             tracks_meta = self.get_albums_meta(tracks)
         else:
             tracks_meta = self.get_tracks_meta(tracks)
@@ -362,42 +1053,153 @@ class PlaylistCreator(object):
 
     def make_playlist_from_keys(self, name, desc, track_keys):
         ordered_unique_track_keys = uniq(track_keys)
-        unique_track_keys = set(ordered_unique_track_keys)
 
         if not ordered_unique_track_keys:
             LOGGER.warn('No tracks found')
             return
 
+        if self.dry_run:
+            plan = self.plan_playlist_from_keys(name, ordered_unique_track_keys)
+            print format_plan(plan)
+            return plan
+
         name = best_unicode(name)
         desc = best_unicode(desc)
+        chunk_size = max(1, self.setting('write_chunk_size', 500))
 
-        # ask the server for playlists
+        with self.metrics.phase('write'):
+            # ask the server for playlists
+            playlist = self.find_owned_playlist(name)
+            if playlist is not None:
+                LOGGER.info('Found the playlist')
+                self.update_playlist(playlist, ordered_unique_track_keys, chunk_size)
+                LOGGER.info('Updated the playlist')
+            else:
+                # didn't find the playlist
+                # create it!
+                self.create_playlist(name, desc, ordered_unique_track_keys, chunk_size)
+                LOGGER.info('Created the playlist')
+
+    def find_owned_playlist(self, name):
         playlists = self.rdio.getPlaylists()
         for playlist in playlists['owned']:
             # look for a playlist with the right name
             if playlist['name'] == name:
-                LOGGER.info('Found the playlist')
-                # when we find it, remove all of those tracks...
-                playlist = self.rdio.get(keys=playlist['key'], extras='tracks')[playlist['key']]
-                playlist_keys = set([t['key'] for t in playlist['tracks']])
-                remove_keys = playlist_keys - unique_track_keys
-                if remove_keys:
-                    self.rdio.removeFromPlaylist(playlist=playlist['key'],
-                                                 index=0, count=playlist['length'],
-                                                 tracks=','.join(remove_keys))
-                # now add all of the tracks we just got
-                add_keys = unique_track_keys - playlist_keys
-                if add_keys:
-                    self.rdio.addToPlaylist(playlist=playlist['key'], tracks=','.join(add_keys))
-                LOGGER.info('Updated the playlist')
+                return playlist
+        return None
+
+    def write_chunks(self, write, keys, chunk_size):
+        """Call write with consecutive chunks of keys, in order.
+
+        A chunk the server refuses as too large is split in half and each
+        half retried, down to single keys. Any other error is raised, since
+        it would fail again at every size or may have been partly applied.
+        """
+        for start in range(0, len(keys), chunk_size):
+            self._write_chunk(write, keys[start:start + chunk_size])
+
+    def _write_chunk(self, write, chunk):
+        from transport import too_large
+        try:
+            write(chunk)
+        except Exception as ex:
+            if len(chunk) < 2 or not too_large(ex):
+                raise
+            LOGGER.warning('Writing %d tracks failed, splitting: %s', len(chunk), ex)
+            self.metrics.incr('writes.split')
+            middle = len(chunk) // 2
+            self._write_chunk(write, chunk[:middle])
+            self._write_chunk(write, chunk[middle:])
+
+    def create_playlist(self, name, desc, track_keys, chunk_size):
+        """Create a playlist with the first chunk of track keys, then append the rest in order."""
+        from transport import too_large
+        first = track_keys[:chunk_size]
+        while True:
+            try:
+                playlist = self.rdio.createPlaylist(name=name.encode('utf-8'),
+                                                    description=desc.encode('utf-8'),
+                                                    tracks=','.join(first))
                 break
-        else:
-            # didn't find the playlist
-            # create it!
-            playlist = self.rdio.createPlaylist(name=name.encode('utf-8'),
-                                                description=desc.encode('utf-8'),
-                                                tracks=','.join(ordered_unique_track_keys))
-            LOGGER.info('Created the playlist')
+            except Exception as ex:
+                # a create that timed out may still have happened; never make a second playlist
+                existing = self.find_owned_playlist(name)
+                if existing is not None:
+                    LOGGER.warning('createPlaylist failed but the playlist exists, syncing it: %s', ex)
+                    self.update_playlist(existing, track_keys, chunk_size)
+                    return
+                if len(first) < 2 or not too_large(ex):
+                    raise
+                LOGGER.warning('createPlaylist with %d tracks failed, splitting: %s', len(first), ex)
+                self.metrics.incr('writes.split')
+                first = first[:len(first) // 2]
+        self.write_chunks(
+          lambda chunk: self.rdio.addToPlaylist(playlist=playlist['key'], tracks=','.join(chunk)),
+          track_keys[len(first):], chunk_size)
+        self._remember_playlist_keys(playlist, list(track_keys))
+
+    def _remember_playlist_keys(self, playlist, track_keys, last_updated=None, stored=None):
+        # after our own writes the new lastUpdated isn't known until the playlist is next listed
+        self._playlist_keys[playlist['key']] = (track_keys, last_updated, stored or time.time())
+
+    def playlist_track_keys(self, playlist):
+        """The track keys of a playlist, in order, fetched a page at a time without the tracks themselves.
+
+        The keys are reused for up to `playlist_keys_ttl` seconds while the
+        playlist's length and lastUpdated, as listed by getPlaylists, still match.
+        """
+        cached = self._playlist_keys.get(playlist['key'])
+        if cached is not None:
+            track_keys, last_updated, stored = cached
+            fresh = time.time() - stored < self.setting('playlist_keys_ttl', 600.0)
+            same = len(track_keys) == playlist.get('length') and last_updated in (None, playlist.get('lastUpdated'))
+            if fresh and same:
+                self.metrics.incr('playlist_keys.hits')
+                if last_updated is None:
+                    self._remember_playlist_keys(playlist, track_keys, playlist.get('lastUpdated'), stored)
+                return track_keys
+        self.metrics.incr('playlist_keys.misses')
+        track_keys = []
+        count = 1000
+        while True:
+            playlist_tracks = self.rdio.get(
+              keys=playlist['key'],
+              extras='[{"field":"*","exclude":true},{"field":"length"},{"field":"tracks","start":%s,"count":%s,"extras":[{"field":"*","exclude":true},{"field":"key"}]}]' % (
+                len(track_keys), count)
+            ).get(playlist['key'])
+            if not playlist_tracks or not playlist_tracks.get('tracks'):
+                break
+            track_keys += [track['key'] for track in playlist_tracks['tracks']]
+            if len(track_keys) >= playlist_tracks.get('length', playlist.get('length', 0)):
+                break
+        self._remember_playlist_keys(playlist, track_keys, playlist.get('lastUpdated'))
+        return track_keys
+
+    def update_playlist(self, playlist, track_keys, chunk_size):
+        """Remove the tracks not in track_keys from a playlist and append the missing ones in order."""
+        playlist_keys = self.playlist_track_keys(playlist)
+        length = len(playlist_keys)
+        # forget the keys until the writes are done, so a failed sync is fetched again
+        self._playlist_keys.pop(playlist['key'], None)
+        # when we find it, remove all of those tracks...
+        wanted = set(track_keys)
+        remove_keys = uniq(key for key in playlist_keys if key not in wanted)
+        if remove_keys:
+            self.write_chunks(
+              lambda chunk: self.rdio.removeFromPlaylist(playlist=playlist['key'],
+                                                         index=0, count=length,
+                                                         tracks=','.join(chunk)),
+              remove_keys, chunk_size)
+        # now add all of the tracks we just got
+        present = set(playlist_keys)
+        add_keys = [key for key in track_keys if key not in present]
+        if add_keys:
+            self.write_chunks(
+              lambda chunk: self.rdio.addToPlaylist(playlist=playlist['key'], tracks=','.join(chunk)),
+              add_keys, chunk_size)
+        self._remember_playlist_keys(
+          playlist, [key for key in playlist_keys if key in wanted] + add_keys,
+          None if remove_keys or add_keys else playlist.get('lastUpdated'))
 
     def get_user(self, username=None, email=None, uid_key=None):
         if uid_key is not None:
@@ -411,14 +1213,54 @@ class PlaylistCreator(object):
         elif username is not None:
             current_user = self.rdio.findUser(vanityName=username, extras='vanityName')
         else:
-            current_user = self.rdio.currentUser(extras='vanityName')
+            current_user = self.current_user()
         return current_user
 
-    def get_favorites_playlist(self, current_user=None):
+    def get_users(self, identifiers):
+        """Look up many users by uid key, email or username.
+
+        Keys ("s" and digits) are fetched in batched `get` calls; emails and
+        usernames need one `findUser` each. Returns (identifier, user or None,
+        error or None) triples in input order: a failed lookup is reported
+        with its identifier rather than raised.
+        """
+        found = {}
+        errors = {}
+        unique_keys = uniq(identifier for identifier in identifiers if USER_KEY_RE.match(identifier))
+        for start in range(0, len(unique_keys), USER_BATCH_SIZE):
+            batch = unique_keys[start:start + USER_BATCH_SIZE]
+            try:
+                found.update(self.rdio.get(keys=','.join(batch), extras='vanityName'))
+            except Exception as ex:
+                # find out which keys are at fault, and don't lose the others with them
+                LOGGER.warning('Looking up %d users failed, trying them one at a time: %s', len(batch), ex)
+                for key in batch:
+                    try:
+                        found.update(self.rdio.get(keys=key, extras='vanityName'))
+                    except Exception as ex:
+                        errors[key] = ex
+
+        users = []
+        for identifier in identifiers:
+            user = error = None
+            try:
+                if USER_KEY_RE.match(identifier):
+                    user = found.get(identifier)
+                    error = errors.get(identifier)
+                elif '@' in identifier:
+                    user = self.get_user(email=identifier)
+                else:
+                    user = self.get_user(username=identifier)
+            except Exception as ex:
+                error = ex
+            users.append((identifier, user, error))
+        return users
+
+    def get_favorites_playlist(self, current_user=None, strings=None):
         count = 100
 
         if current_user is None:
-            current_user = self.rdio.currentUser()
+            current_user = self.current_user()
 
         current_user_key = current_user['key']
         fullName = '%s %s' % (current_user['firstName'], current_user['lastName'])
@@ -439,11 +1281,7 @@ class PlaylistCreator(object):
               count=count,
               user=current_user_key
             )
-            for item in favorites_response:
-                if 'tracks' not in item:
-                    favorite_tracks.append(item)
-                else:
-                    favorite_tracks += item['tracks']
+            favorite_tracks += compact_tracks(favorites_response, strings)
             if len(favorites_response) < count:
                 break
             start += len(favorites_response)
@@ -468,11 +1306,11 @@ class PlaylistCreator(object):
           u'playlist_type': 'collection'
         }
 
-    def get_offline_tracks(self, current_user=None):
+    def get_offline_tracks(self, current_user=None, strings=None):
         count = 100
 
         if current_user is None:
-            current_user = self.rdio.currentUser()
+            current_user = self.current_user()
 
         current_user_key = current_user['key']
         fullName = '%s %s' % (current_user['firstName'], current_user['lastName'])
@@ -492,11 +1330,7 @@ class PlaylistCreator(object):
               count=count,
               user=current_user_key
             )
-            for item in favorites_response:
-                if 'tracks' not in item:
-                    favorite_tracks.append(item)
-                else:
-                    favorite_tracks += item['tracks']
+            favorite_tracks += compact_tracks(favorites_response, strings)
             if len(favorites_response) < count:
                 break
             start += len(favorites_response)
@@ -525,11 +1359,13 @@ class PlaylistCreator(object):
         count = 100
 
         if current_user is None:
-            current_user = self.rdio.currentUser()
+            current_user = self.current_user()
         current_user_key = current_user['key']
+        # the tracks of one listing share their repeated strings, and the table goes with the listing
+        strings = {}
 
-        yield self.get_favorites_playlist(current_user)
-        yield self.get_offline_tracks(current_user)
+        yield self.get_favorites_playlist(current_user, strings)
+        yield self.get_offline_tracks(current_user, strings)
 
         playlist_response = self.rdio.getPlaylists(user=current_user_key)
 
@@ -555,7 +1391,7 @@ class PlaylistCreator(object):
                     )[playlist['key']]
                     if not playlist_tracks or 'tracks' not in playlist_tracks:
                         break
-                    playlist['tracks'] += playlist_tracks['tracks']
+                    playlist['tracks'] += compact_tracks(playlist_tracks['tracks'], strings)
                     if len(playlist_tracks['tracks']) < count:
                         break
                     start += len(playlist_tracks['tracks'])
@@ -564,7 +1400,7 @@ class PlaylistCreator(object):
 
     def get_favorite_artists(self, current_user):
         if current_user is None:
-            current_user = self.rdio.currentUser()
+            current_user = self.current_user()
 
         current_user_key = current_user['key']
 
@@ -585,7 +1421,7 @@ class PlaylistCreator(object):
 
     def get_favorite_labels(self, current_user):
         if current_user is None:
-            current_user = self.rdio.currentUser()
+            current_user = self.current_user()
 
         current_user_key = current_user['key']
 
@@ -606,7 +1442,7 @@ class PlaylistCreator(object):
 
     def get_favorite_stations(self, current_user):
         if current_user is None:
-            current_user = self.rdio.currentUser()
+            current_user = self.current_user()
 
         current_user_key = current_user['key']
 
@@ -627,7 +1463,7 @@ class PlaylistCreator(object):
 
     def list_comments(self, current_user=None):
         if current_user is None:
-            current_user = self.rdio.currentUser()
+            current_user = self.current_user()
 
         current_user_key = current_user['key']
 
@@ -0,0 +1,169 @@
+"""Opt-in profiling for long runs: a sampling stack profiler and deterministic profiling of matching."""
+
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+# the PlaylistCreator methods that all fuzzy matching goes through
+MATCHING_METHODS = ['plan_queries', 'match', 'first_match']
+
+
+def frame_label(frame):
+    code = frame.f_code
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return '%s:%s' % (module, code.co_name)
+
+
+class StackSampler(object):
+    """Sample every thread's stack every `interval` seconds from a background thread.
+
+    Samples are kept as counts of collapsed stacks, root first, which is the
+    input format of flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='stack-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        names = {}
+        while not self._stopped.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == self._thread.ident:
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(frame_label(frame))
+                    frame = frame.f_back
+                labels.append(names.get(ident, 'thread-%s' % ident))
+                stack = ';'.join(reversed(labels))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
+
+    def write(self, filename):
+        with open(filename, 'w') as outfile:
+            for stack, count in sorted(self.stacks.items()):
+                outfile.write('%s %d\n' % (stack, count))
+
+
+class MatchingProfiler(object):
+    """Deterministically profile only the calls made inside PlaylistCreator's matching methods.
+
+    cProfile only sees the thread that enabled it, so each thread gets its own
+    profiler and they are merged when written.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._profiles = []
+        self._lock = threading.Lock()
+        self._pc = None
+        self._replaced = {}
+
+    def _profile(self):
+        profile = getattr(self._local, 'profile', None)
+        if profile is None:
+            import cProfile
+            profile = self._local.profile = cProfile.Profile()
+            self._local.depth = 0
+            with self._lock:
+                self._profiles.append(profile)
+        return profile
+
+    def wrap(self, function):
+        @wraps(function)
+        def profiled(*args, **kwargs):
+            profile = self._profile()
+            # nested matching calls are already inside the profiled call
+            if self._local.depth:
+                return function(*args, **kwargs)
+            self._local.depth += 1
+            profile.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profile.disable()
+                self._local.depth -= 1
+        return profiled
+
+    def install(self, pc):
+        """Wrap pc's matching methods until uninstall(), which puts the originals back."""
+        self._pc = pc
+        for name in MATCHING_METHODS:
+            # usually nothing: the method comes from the class
+            self._replaced[name] = pc.__dict__.get(name)
+            setattr(pc, name, self.wrap(getattr(pc, name)))
+
+    def uninstall(self):
+        for name, original in self._replaced.items():
+            if original is None:
+                delattr(self._pc, name)
+            else:
+                setattr(self._pc, name, original)
+        self._replaced = {}
+        self._pc = None
+
+    def write(self, filename):
+        with self._lock:
+            profiles = list(self._profiles)
+        if not profiles:
+            return
+        import pstats
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(filename)
+
+
+def add_options(parser):
+    parser.add_option(
+      "--profile-samples", dest="profile_samples", default=None,
+      help="sample stacks during the run and write them to FILE for flame graphs", metavar="FILE"
+    )
+    parser.add_option(
+      "--profile-interval", dest="profile_interval", type="float", default=0.01,
+      help="seconds between stack samples", metavar="SECONDS"
+    )
+    parser.add_option(
+      "--profile-matching", dest="profile_matching", default=None,
+      help="profile only the matching code and write pstats data to FILE", metavar="FILE"
+    )
+
+
+@contextmanager
+def profiling(pc, options):
+    """Run the body under whichever profilers the command line options asked for."""
+    sampler = None
+    matching = None
+    if options.get('profile_samples'):
+        sampler = StackSampler(options.get('profile_interval') or 0.01)
+        sampler.start()
+    if options.get('profile_matching'):
+        matching = MatchingProfiler()
+        matching.install(pc)
+    try:
+        yield
+    finally:
+        if sampler is not None:
+            sampler.stop()
+            sampler.write(options['profile_samples'])
+        if matching is not None:
+            # a daemon reuses pc, and later jobs must not stay profiled
+            matching.uninstall()
+            matching.write(options['profile_matching'])
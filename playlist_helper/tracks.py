@@ -0,0 +1,134 @@
+"""A compact record for API tracks, so long dumps don't keep a dict per track."""
+
+# the fields every writer uses get a slot; anything else the API sends is kept in `extra`
+FIELDS = ('key', 'artist', 'album', 'name', 'duration', 'trackNum', 'isrcs')
+
+# values that repeat across the tracks of an album or an artist, worth sharing
+INTERNED_FIELDS = frozenset([
+  'artist', 'album', 'albumArtist', 'artistKey', 'albumKey', 'albumArtistKey',
+  'artistUrl', 'albumUrl', 'icon', 'icon400', 'baseIcon', 'bigIcon', 'dynamicIcon', 'type',
+])
+
+
+def intern_string(value, strings):
+    """Share one copy of a repeated str or unicode value through the `strings` table, if there is one.
+
+    The builtin intern() only takes str, and its table lives as long as the
+    process; a table per run is dropped with the run.
+    """
+    if strings is None:
+        return value
+    return strings.setdefault(value, value)
+
+
+def _intern_value(field, value, strings):
+    if field in INTERNED_FIELDS and isinstance(value, basestring):
+        return intern_string(value, strings)
+    return value
+
+
+class Track(object):
+    """A read-only track that answers the dict lookups the writers make.
+
+    Fields the API did not send stay unset, so `in`, `get` and `items()`
+    behave as they did on the raw dict. Repeated values are shared through
+    `strings`, when given.
+    """
+
+    __slots__ = FIELDS + ('extra',)
+
+    def __init__(self, data, extras=True, strings=None):
+        for field in FIELDS:
+            if field in data:
+                value = data[field]
+                if field == 'isrcs' and value is not None:
+                    value = tuple(value)
+                object.__setattr__(self, field, _intern_value(field, value, strings))
+        if extras:
+            extra = tuple(
+              (intern_string(field, strings), _intern_value(field, value, strings))
+              for field, value in data.items() if field not in FIELDS
+            )
+        else:
+            extra = ()
+        object.__setattr__(self, 'extra', extra)
+
+    @classmethod
+    def from_api(cls, data, extras=True, strings=None):
+        """Wrap an API track dict, leaving anything that is already a Track alone."""
+        if isinstance(data, cls):
+            return data
+        return cls(data, extras, strings)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Track is read-only')
+
+    def __reduce__(self):
+        # the default reduce for slotted classes needs pickle protocol 2; shelve uses 0
+        return (Track, (dict(self.items()),))
+
+    def __getitem__(self, field):
+        if field in FIELDS:
+            try:
+                value = getattr(self, field)
+            except AttributeError:
+                raise KeyError(field)
+            if field == 'isrcs' and value is not None:
+                return list(value)
+            return value
+        for name, value in self.extra:
+            if name == field:
+                return value
+        raise KeyError(field)
+
+    def get(self, field, default=None):
+        try:
+            return self[field]
+        except KeyError:
+            return default
+
+    def __contains__(self, field):
+        try:
+            self[field]
+        except KeyError:
+            return False
+        return True
+
+    def keys(self):
+        return [field for field, _ in self.items()]
+
+    def items(self):
+        items = []
+        for field in FIELDS:
+            if hasattr(self, field):
+                items.append((field, self[field]))
+        return items + list(self.extra)
+
+    def __eq__(self, other):
+        if isinstance(other, (Track, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Track(%r)' % dict(self.items())
+
+
+def compact_tracks(items, strings=None):
+    """Convert the tracks in a page of API items, expanding albums into their tracks.
+
+    Pass the same `strings` dict for every page of a run to share values
+    across all of them.
+    """
+    tracks = []
+    for item in items:
+        if 'tracks' in item:
+            tracks.extend(Track.from_api(track, strings=strings) for track in item['tracks'])
+        else:
+            tracks.append(Track.from_api(item, strings=strings))
+    return tracks
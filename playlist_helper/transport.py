@@ -0,0 +1,474 @@
+"""Middleware that sits between PlaylistCreator and the Rdio API client."""
+
+import copy
+import httplib
+import logging
+import random
+import select
+import socket
+import threading
+import time
+import urllib
+import urllib2
+from StringIO import StringIO
+
+LOGGER = logging.getLogger(__name__)
+
+# API methods that only read, and so can safely be sent again after a failure
+IDEMPOTENT_METHODS = set([
+  'currentUser',
+  'findUser',
+  'get',
+  'getFavorites',
+  'getPlaylists',
+  'getSynced',
+  'search',
+])
+
+# attributes of the client itself rather than API methods
+CLIENT_ATTRIBUTES = set([
+  'authenticated',
+  'begin_authentication',
+  'complete_authentication',
+  'logout',
+])
+
+THROTTLED_CODES = set([429, 503])
+# a 429 is the server refusing the call; a 503 may come from a proxy after the call was applied
+REFUSED_CODES = set([429])
+
+# responses that refuse a request for its size, before any of it is applied
+TOO_LARGE_CODES = set([413, 414])
+
+TRANSIENT_ERRORS = (urllib2.URLError, httplib.HTTPException, socket.error)
+
+
+class TokenBucket(object):
+    """A thread-safe token bucket allowing `rate` calls a second in bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._updated = time.time()
+        self._not_before = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = max(0, now - self._updated)
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """Block until a token is available, then take it."""
+        while True:
+            with self._lock:
+                now = time.time()
+                self._refill(now)
+                if now >= self._not_before and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._not_before - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Hold every caller back for `seconds`, e.g. when the server says to slow down."""
+        with self._lock:
+            self._not_before = max(self._not_before, time.time() + seconds)
+            self._tokens = 0
+
+
+class LatencyHistogram(object):
+    """Counts of call latencies in fixed buckets."""
+
+    BOUNDS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf')]
+
+    def __init__(self):
+        self.counts = [0] * len(self.BOUNDS)
+        self.total = 0.0
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+
+    def observe(self, seconds):
+        self.calls += 1
+        self.total += seconds
+        for i, bound in enumerate(self.BOUNDS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+
+    def as_dict(self):
+        return {
+          'calls': self.calls,
+          'errors': self.errors,
+          'retries': self.retries,
+          'seconds': self.total,
+          # [label, count] pairs, smallest bound first
+          'buckets': [['<=%g' % bound, count] for bound, count in zip(self.BOUNDS, self.counts)],
+        }
+
+    def __str__(self):
+        mean = self.total / self.calls if self.calls else 0
+        buckets = ', '.join(
+          '<=%gs: %d' % (bound, count) for bound, count in zip(self.BOUNDS, self.counts) if count
+        )
+        return '%d calls, %d retries, %d errors, mean %.3fs (%s)' % (
+          self.calls, self.retries, self.errors, mean, buckets)
+
+
+def too_large(ex):
+    """Whether an API call failed only because the request was too big, so a smaller one may work."""
+    return isinstance(ex, urllib2.HTTPError) and ex.code in TOO_LARGE_CODES
+
+
+def retry_after(ex):
+    """How long a throttled response asked us to wait, if it said."""
+    headers = getattr(ex, 'hdrs', None) or getattr(ex, 'headers', None)
+    if headers is None:
+        return None
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimitedClient(object):
+    """Wrap an Rdio client with a shared rate limit, retries and per-method latency histograms.
+
+    Every API call waits for a token from the bucket. Idempotent calls that fail
+    with a transient network error or a server error are retried with jittered
+    exponential backoff; throttling responses pause the whole bucket. Writes
+    are only sent again when the server refused them with a 429.
+    """
+
+    def __init__(self, client, bucket, retries=4, backoff=0.5, max_backoff=30.0):
+        self._client = client
+        self._bucket = bucket
+        self._retries = retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.latencies = {}
+
+    def thread_calls(self):
+        """Return how many requests the current thread has sent since it last asked."""
+        calls = getattr(self._local, 'calls', 0)
+        self._local.calls = 0
+        return calls
+
+    def _histogram(self, method):
+        with self._lock:
+            if method not in self.latencies:
+                self.latencies[method] = LatencyHistogram()
+            return self.latencies[method]
+
+    def _delay(self, attempt):
+        return random.uniform(0, min(self._max_backoff, self._backoff * (2 ** attempt)))
+
+    def call(self, method, **kwargs):
+        histogram = self._histogram(method)
+        function = getattr(self._client, method)
+        idempotent = method in IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            self._bucket.acquire()
+            self._local.calls = getattr(self._local, 'calls', 0) + 1
+            started = time.time()
+            retryable = idempotent
+            throttled = False
+            try:
+                result = function(**kwargs)
+            except urllib2.HTTPError as ex:
+                elapsed = time.time() - started
+                if ex.code in THROTTLED_CODES:
+                    throttled = True
+                    retryable = idempotent or ex.code in REFUSED_CODES
+                    delay = retry_after(ex)
+                    if delay is None:
+                        delay = self._delay(attempt)
+                elif ex.code < 500:
+                    self._failed(histogram, elapsed)
+                    raise
+                else:
+                    delay = self._delay(attempt)
+                error = ex
+            except TRANSIENT_ERRORS as ex:
+                elapsed = time.time() - started
+                delay = self._delay(attempt)
+                error = ex
+            else:
+                with self._lock:
+                    histogram.observe(time.time() - started)
+                return result
+
+            if not retryable or attempt >= self._retries:
+                self._failed(histogram, elapsed)
+                raise error
+            attempt += 1
+            with self._lock:
+                histogram.retries += 1
+            LOGGER.warning('%s failed (%s), retry %d/%d in %.1fs', method, error, attempt, self._retries, delay)
+            if throttled:
+                # every caller, this one included, waits for the bucket to reopen
+                self._bucket.pause(delay)
+            else:
+                time.sleep(delay)
+
+    def _failed(self, histogram, elapsed):
+        with self._lock:
+            histogram.observe(elapsed)
+            histogram.errors += 1
+
+    def reset_stats(self):
+        """Forget the latencies measured so far."""
+        with self._lock:
+            self.latencies = {}
+
+    def format_latencies(self):
+        return '\n'.join(
+          '%s: %s' % (method, histogram) for method, histogram in sorted(self.latencies.items())
+        )
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name in CLIENT_ATTRIBUTES:
+            return getattr(self._client, name)
+
+        def api_method(**kwargs):
+            return self.call(name, **kwargs)
+        return api_method
+
+
+class _Flight(object):
+    """One in-flight call that other callers can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class CoalescingClient(object):
+    """Share one in-flight request between concurrent identical idempotent calls.
+
+    The first caller makes the request; callers arriving with the same method
+    and arguments before it returns wait for it and get a copy of its result,
+    or its exception. Everything else passes straight through to the wrapped client.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.coalesced = {}
+
+    def call(self, method, **kwargs):
+        key = (method, tuple(sorted(kwargs.items())))
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                flight.waiters += 1
+                self.coalesced[method] = self.coalesced.get(method, 0) + 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            # leader and waiters must not be able to mutate each other's results
+            return copy.deepcopy(flight.result)
+
+        try:
+            flight.result = getattr(self._client, method)(**kwargs)
+        except Exception as ex:
+            flight.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        if flight.waiters:
+            return copy.deepcopy(flight.result)
+        return flight.result
+
+    def reset_stats(self):
+        """Forget the coalesced calls counted so far, and the wrapped client's own stats."""
+        with self._lock:
+            self.coalesced = {}
+        self._client.reset_stats()
+
+    def format_coalesced(self):
+        return ', '.join('%s: %d' % item for item in sorted(self.coalesced.items())) or 'none'
+
+    def __getattr__(self, name):
+        if name not in IDEMPOTENT_METHODS:
+            return getattr(self._client, name)
+
+        def api_method(**kwargs):
+            return self.call(name, **kwargs)
+        return api_method
+
+
+def dropped(connection):
+    """Whether the server has closed an idle connection, which then reads as ready (at EOF)."""
+    if connection.sock is None:
+        return True
+    try:
+        return bool(select.select([connection.sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
+
+
+class ConnectionPool(object):
+    """Idle keep-alive HTTP(S) connections shared between threads, up to `size` per host.
+
+    New connections time out after `timeout` seconds unless the request sets its own.
+    """
+
+    CONNECTION_CLASSES = {
+      'http': httplib.HTTPConnection,
+      'https': httplib.HTTPSConnection,
+    }
+
+    def __init__(self, size=4, timeout=None):
+        self.size = size
+        self.timeout = timeout
+        self.requests = 0
+        self.opened = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, scheme, host, timeout):
+        """Return an idle connection to host, or a new one, and whether it was reused."""
+        with self._lock:
+            self.requests += 1
+            idle = self._idle.get((scheme, host), [])
+            while idle:
+                connection = idle.pop()
+                if not dropped(connection):
+                    return connection, True
+                connection.close()
+            self.opened += 1
+        return self.CONNECTION_CLASSES[scheme](host, timeout=timeout), False
+
+    def put(self, scheme, host, connection):
+        """Hand a connection with no outstanding response back for reuse."""
+        with self._lock:
+            idle = self._idle.setdefault((scheme, host), [])
+            if len(idle) < self.size:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for connection in idle:
+                    connection.close()
+            self._idle = {}
+
+    def reset_stats(self):
+        """Count requests and connections afresh; idle connections are kept."""
+        with self._lock:
+            self.requests = 0
+            self.opened = 0
+
+    @property
+    def reuse_rate(self):
+        if not self.requests:
+            return 0.0
+        return 1 - float(self.opened) / self.requests
+
+    def as_dict(self):
+        return {
+          'size': self.size,
+          'requests': self.requests,
+          'opened': self.opened,
+          'reuse_rate': self.reuse_rate,
+        }
+
+    def __str__(self):
+        return '%d requests over %d connections, %.0f%% reused' % (
+          self.requests, self.opened, 100 * self.reuse_rate)
+
+
+class PooledHandler(urllib2.BaseHandler):
+    """A urllib2 handler that sends requests over keep-alive connections from a ConnectionPool.
+
+    It runs ahead of the stock HTTP(S) handlers, whose request preprocessing
+    (Host, Content-Type and Content-Length headers) still applies.
+    """
+
+    handler_order = 400
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def http_open(self, request):
+        return self._open('http', request)
+
+    def https_open(self, request):
+        return self._open('https', request)
+
+    def _open(self, scheme, request):
+        host = request.get_host()
+        headers = dict(request.unredirected_hdrs)
+        headers.update(request.headers)
+        headers['Connection'] = 'keep-alive'
+        timeout = request.timeout
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            timeout = self.pool.timeout
+        while True:
+            connection, reused = self.pool.get(scheme, host, timeout)
+            try:
+                connection.request(request.get_method(), request.get_selector(), request.get_data(), headers)
+            except (httplib.HTTPException, socket.error) as ex:
+                connection.close()
+                if reused:
+                    # the server closed an idle connection before the request went out; use a fresh one
+                    continue
+                raise urllib2.URLError(ex)
+            break
+        try:
+            response = connection.getresponse()
+            # read the whole body so the connection is free for the next request
+            body = response.read()
+        except (httplib.HTTPException, socket.error) as ex:
+            # the request may have been applied, so it is up to the caller whether to send it again
+            connection.close()
+            raise urllib2.URLError(ex)
+
+        if response.will_close:
+            connection.close()
+        else:
+            self.pool.put(scheme, host, connection)
+
+        result = urllib.addinfourl(StringIO(body), response.msg, request.get_full_url())
+        result.code = response.status
+        result.msg = response.reason
+        return result
+
+
+class PooledUrllib2(object):
+    """Stands in for urllib2 in one module, sending its urlopen calls through a private pooled opener."""
+
+    def __init__(self, pool):
+        self.opener = urllib2.build_opener(PooledHandler(pool))
+
+    def urlopen(self, url, data=None, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        return self.opener.open(url, data, timeout)
+
+    def __getattr__(self, name):
+        return getattr(urllib2, name)
+
+
+def use_connection_pool(module, pool):
+    """Route the urllib2.urlopen calls made by `module` through `pool`, leaving urllib2's global opener alone."""
+    if getattr(module, 'urllib2', None) is None:
+        LOGGER.warning('%s does not use urllib2, so its requests will not use the connection pool', module.__name__)
+        return
+    module.urllib2 = PooledUrllib2(pool)
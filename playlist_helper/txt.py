@@ -5,7 +5,9 @@ import re
 import sys
 from optparse import OptionParser
 
+from metrics import write_report
 from playlistcreator import PlaylistCreator
+from profiling import add_options as add_profiling_options, profiling
 
 sample = """
 "Snack Attack" - Godley & Creme
@@ -56,35 +58,63 @@ def process_txt(pc, options, filename):
         logger.error('Empty playlist: %s', filename)
 
     tracks = []
-    for line in contents.split('\n'):
-        matches = match(options['regex'], line)
-        logger.debug('%s', matches)
-        if matches:
-            artist = matches.get('artist')
-            album = matches.get('album')
-            track = matches.get('track')
-            tracks.append([artist, album, track])
-    pc.make_playlist(playlist_name, playlist_description, tracks)
-
-
-def main(options, args):
+    with pc.metrics.phase('parse'):
+        for line in contents.split('\n'):
+            matches = match(options['regex'], line)
+            logger.debug('%s', matches)
+            if matches:
+                artist = matches.get('artist')
+                album = matches.get('album')
+                track = matches.get('track')
+                tracks.append([artist, album, track])
+    if options.get('queue') and not pc.dry_run:
+        from jobqueue import run_import
+        run_import(pc, options['queue'], playlist_name, playlist_description, tracks)
+    else:
+        pc.make_playlist(playlist_name, playlist_description, tracks)
+
+
+def main(options, args, pc=None):
     logger.debug('Options: %s', options)
-    pc = PlaylistCreator()
-    if not pc.authenticated:
-        logger.error('You need to authenticate by running ./authenticate.py first')
-        sys.exit(0)
-
-    for arg in args:
-        process_txt(pc, options, arg)
-
-
-if __name__ == "__main__":
+    if pc is None:
+        pc = PlaylistCreator(dry_run=options.get('dry_run'))
+        if not pc.dry_run and not pc.authenticated:
+            logger.error('You need to authenticate by running ./authenticate.py first')
+            sys.exit(0)
+
+    with profiling(pc, options):
+        for arg in args:
+            process_txt(pc, options, arg)
+    if not pc.dry_run:
+        logger.info(pc.format_api_stats())
+    if options['report']:
+        write_report(options['report'], pc.run_report('txt'))
+
+
+def make_parser():
     parser = OptionParser()
     parser.add_option(
       "-r", "--regex", dest="regex",
       help="regex to match per line", default=r'(?P<artist>.*)\t(?P<album>.*)\t(?P<track>.*)'
     )
     parser.add_option("-d", "--description", dest="description", help="The description for the playlist", default=None)
-    (options, args) = parser.parse_args()
+    parser.add_option(
+      "--dry-run", dest="dry_run", action="store_true", default=False,
+      help="report the API calls an import would make without making them"
+    )
+    parser.add_option(
+      "--report", dest="report", default=None,
+      help="write timings and API call counts for the run to FILE as json", metavar="FILE"
+    )
+    parser.add_option(
+      "--queue", dest="queue", default=None,
+      help="record progress in the sqlite job queue FILE so an interrupted import can be resumed", metavar="FILE"
+    )
+    add_profiling_options(parser)
+    return parser
+
+
+if __name__ == "__main__":
+    (options, args) = make_parser().parse_args()
     options = options.__dict__
     main(options, args)
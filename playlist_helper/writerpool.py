@@ -0,0 +1,97 @@
+"""Write output files on a pool of threads, each to a temp file that is renamed into place when complete.
+
+A run that dies mid-write leaves at most a hidden `.name.*.tmp` file
+behind, never a truncated file under the real name.
+"""
+import errno
+import os
+import sys
+import threading
+
+
+def _create_temp(folder, name):
+    """Create a new, empty temp file next to `name` and return its descriptor and path.
+
+    Unlike mkstemp, which makes files readable only by their owner, this
+    leaves the mode to the umask, as open() would.
+    """
+    while True:
+        temp_filename = os.path.join(folder, '.%s.%s.tmp' % (name, os.urandom(6).encode('hex')))
+        try:
+            return os.open(temp_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666), temp_filename
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+
+
+def write_atomic(filename, data):
+    """Write bytes to filename through a temp file in the same folder and a rename."""
+    folder, name = os.path.split(filename)
+    fd, temp_filename = _create_temp(folder or '.', name)
+    try:
+        with os.fdopen(fd, 'wb') as outfile:
+            outfile.write(data)
+        os.rename(temp_filename, filename)
+    except BaseException:
+        os.remove(temp_filename)
+        raise
+    return len(data)
+
+
+class WriterPool(object):
+    """Render and write files on `threads` threads; with 0 threads, write them right away.
+
+    At most `backlog` files wait to be written, so a fast producer can't
+    pile up rendered output. The first error is raised again by `submit`
+    or `close`.
+    """
+
+    def __init__(self, threads=4, backlog=None):
+        self.threads = threads
+        self.files = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._exc_info = None
+        self._pool = None
+        if threads > 0:
+            from multiprocessing.pool import ThreadPool
+            self._pool = ThreadPool(threads)
+            self._slots = threading.BoundedSemaphore(backlog or threads * 4)
+
+    def submit(self, filename, render, *args):
+        """Write the bytes returned by render(*args) to filename."""
+        self._raise_error()
+        if self._pool is None:
+            self._write(filename, render, args)
+            return
+        self._slots.acquire()
+        self._pool.apply_async(self._run, (filename, render, args))
+
+    def _write(self, filename, render, args):
+        written = write_atomic(filename, render(*args))
+        with self._lock:
+            self.files += 1
+            self.bytes += written
+
+    def _run(self, filename, render, args):
+        try:
+            self._write(filename, render, args)
+        except Exception:
+            with self._lock:
+                if self._exc_info is None:
+                    self._exc_info = sys.exc_info()
+        finally:
+            self._slots.release()
+
+    def _raise_error(self):
+        if self._exc_info is not None:
+            exc_info, self._exc_info = self._exc_info, None
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def close(self):
+        """Wait for every submitted file to be written."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        self._raise_error()